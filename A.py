@@ -1,23 +1,141 @@
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash, after_this_request
+from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash, after_this_request, Response, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import yt_dlp
+from yt_dlp.networking.exceptions import HTTPError as UpstreamHTTPError
 import os
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
 import time # <--- ADDED THIS IMPORT
 from werkzeug.security import generate_password_hash, check_password_hash
-import tempfile
 import shutil
+import queue
+import json
+import logging
+import contextvars
+import random
+import sys
+import re
+import hashlib
+import hmac
+import socket
+import mimetypes
+import subprocess
+import zipfile
+import math
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from urllib.parse import quote, urlparse
+import sqlite3
+from sqlalchemy import and_, case, event, func, insert, or_, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError, OperationalError
+try:
+    import resource
+except ImportError:
+    resource = None # Windows: no per-process memory limits
 
 app = Flask(__name__)
 # IMPORTANT: Change this to a strong, unique secret key!
 app.config['SECRET_KEY'] = '21b73249a34e893eefc6c7efa744fde53ae334627c613a83feef32a575bbff25'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////var/data/youtube_downloader.db' # Ensure this is correct for Render persistent disk
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:////var/data/youtube_downloader.db') # Ensure this is correct for Render persistent disk
 # --- MODIFIED UPLOAD_FOLDER TO USE PERSISTENT DISK ---
-app.config['UPLOAD_FOLDER'] = '/var/data/downloads' # This folder will now store permanent downloads on the persistent disk
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', '/var/data/downloads') # This folder will now store permanent downloads on the persistent disk
+# Web threads, download workers and the janitor all share one engine per process; size the pool for them
+# and let SQLite wait for a lock (busy timeout) instead of failing with "database is locked".
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': 30,
+    'pool_pre_ping': True,
+}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'timeout': 30, 'check_same_thread': False}
+# Jobs each web process fetches at the same time (network bound); the fetching itself runs in download processes
+app.config['DOWNLOAD_WORKERS'] = int(os.environ.get('DOWNLOAD_WORKERS', 2))
+# yt-dlp runs in child processes, not in the web process. A child is replaced after DOWNLOAD_PROCESS_MAX_JOBS
+# jobs and may map at most DOWNLOAD_PROCESS_MEMORY_MB of address space (0 = no limit for either).
+app.config['DOWNLOAD_PROCESS_MAX_JOBS'] = int(os.environ.get('DOWNLOAD_PROCESS_MAX_JOBS', 50))
+app.config['DOWNLOAD_PROCESS_MEMORY_MB'] = int(os.environ.get('DOWNLOAD_PROCESS_MEMORY_MB', 2048))
+# A job still running in its download process after this many seconds fails and the process is killed (0 = no limit)
+app.config['DOWNLOAD_PROCESS_TIMEOUT'] = int(os.environ.get('DOWNLOAD_PROCESS_TIMEOUT', 4 * 3600))
+# How long a stream-mode request waits for a free download process before its job goes to the queue instead
+app.config['DOWNLOAD_PROCESS_WAIT_SECONDS'] = float(os.environ.get('DOWNLOAD_PROCESS_WAIT_SECONDS', 10))
+# Number of ffmpeg conversions (MP3 encode, video/audio merge) running at once (CPU bound)
+app.config['POSTPROCESS_WORKERS'] = int(os.environ.get('POSTPROCESS_WORKERS', os.cpu_count() or 1))
+# Entries of one playlist batch that may be queued or downloading at the same time, and the most
+# entries a single playlist or channel is expanded to
+app.config['PLAYLIST_CONCURRENCY'] = int(os.environ.get('PLAYLIST_CONCURRENCY', 2))
+app.config['PLAYLIST_MAX_ENTRIES'] = int(os.environ.get('PLAYLIST_MAX_ENTRIES', 200))
+# Extracted yt-dlp info dicts are reused for this long; keep it well below the ~6h lifetime of YouTube format URLs
+app.config['METADATA_CACHE_TTL'] = int(os.environ.get('METADATA_CACHE_TTL', 3600))
+app.config['METADATA_CACHE_MAX_ENTRIES'] = int(os.environ.get('METADATA_CACHE_MAX_ENTRIES', 512))
+app.config['METADATA_CACHE_MAX_BYTES'] = int(os.environ.get('METADATA_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Also keep cached info dicts in the database so they survive restarts and are shared between processes
+app.config['METADATA_CACHE_SQLITE'] = os.environ.get('METADATA_CACHE_SQLITE', '0') == '1'
+# How /download_file hands files to the client once ownership is checked:
+#   'direct'     - the Python worker streams the file itself (HTTP Range / 206 and ETags supported)
+#   'x-accel'    - nginx streams it from an internal location mapped to X_ACCEL_PREFIX (X-Accel-Redirect)
+#   'x-sendfile' - Apache mod_xsendfile / lighttpd stream it from the absolute path (X-Sendfile)
+app.config['FILE_SERVING_MODE'] = os.environ.get('FILE_SERVING_MODE', 'direct')
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX', '/protected-downloads/')
+app.config['USE_X_SENDFILE'] = app.config['FILE_SERVING_MODE'] == 'x-sendfile' # Makes send_file() emit X-Sendfile
+# Disk budget for UPLOAD_FOLDER and per-user share of it, in bytes (0 = unlimited). Least recently
+# used files are evicted to stay within them; evicted downloads can be fetched again from the dashboard.
+app.config['STORAGE_BUDGET_BYTES'] = int(os.environ.get('STORAGE_BUDGET_BYTES', 0))
+app.config['USER_QUOTA_BYTES'] = int(os.environ.get('USER_QUOTA_BYTES', 0))
+# Requests to each upstream host (YouTube pages and APIs, media CDNs) share one token bucket stored in the
+# database, so every worker and process draws from it. The rate starts at UPSTREAM_RATE requests/s, grows by
+# UPSTREAM_RATE_INCREASE per second without throttling (up to UPSTREAM_RATE_MAX) and is halved on HTTP 429/403,
+# which also pauses the host for Retry-After or UPSTREAM_PENALTY_SECONDS.
+app.config['UPSTREAM_RATE'] = float(os.environ.get('UPSTREAM_RATE', 5))
+app.config['UPSTREAM_RATE_MIN'] = float(os.environ.get('UPSTREAM_RATE_MIN', 0.2))
+app.config['UPSTREAM_RATE_MAX'] = float(os.environ.get('UPSTREAM_RATE_MAX', 50))
+app.config['UPSTREAM_RATE_INCREASE'] = float(os.environ.get('UPSTREAM_RATE_INCREASE', 0.1))
+app.config['UPSTREAM_BURST'] = float(os.environ.get('UPSTREAM_BURST', 20))
+app.config['UPSTREAM_PENALTY_SECONDS'] = float(os.environ.get('UPSTREAM_PENALTY_SECONDS', 5))
+# A job being worked on holds a lease that its process renews every JOB_HEARTBEAT_SECONDS. When a process
+# dies, its jobs' leases run out and the recovery pass queues them again (up to JOB_MAX_ATTEMPTS attempts in
+# total); they resume from the partial files left in their work directory. The janitor runs the recovery
+# pass and removes orphaned work directories every JANITOR_INTERVAL_SECONDS.
+app.config['JOB_LEASE_SECONDS'] = int(os.environ.get('JOB_LEASE_SECONDS', 60))
+app.config['JOB_HEARTBEAT_SECONDS'] = int(os.environ.get('JOB_HEARTBEAT_SECONDS', 15))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+app.config['JANITOR_INTERVAL_SECONDS'] = int(os.environ.get('JANITOR_INTERVAL_SECONDS', 60))
+# Workers of every process and host take jobs from the pending rows of the database, so any of them can run any
+# job. An idle worker looks for jobs every JOB_POLL_SECONDS; jobs queued by its own process wake it at once.
+# Set RUN_DOWNLOAD_WORKERS=0 on web processes when dedicated `flask --app A worker` processes do the downloading.
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['RUN_DOWNLOAD_WORKERS'] = os.environ.get('RUN_DOWNLOAD_WORKERS', '1') == '1'
+# New jobs are refused with 429 once this many are queued or running across all processes, or for one user (0 = no limit)
+app.config['MAX_ACTIVE_JOBS'] = int(os.environ.get('MAX_ACTIVE_JOBS', 200))
+app.config['MAX_USER_ACTIVE_JOBS'] = int(os.environ.get('MAX_USER_ACTIVE_JOBS', 20))
+# Order of queued jobs (see FairShareScheduler). Jobs whose media is at most SCHEDULER_SHORT_SECONDS long run first
+# and those over SCHEDULER_LONG_SECONDS last (video counts VIDEO_COST_FACTOR times its length); a waiting job moves
+# up one class every SCHEDULER_AGING_SECONDS. SCHEDULER_USER_WEIGHTS gives users a bigger or smaller share of the
+# workers, as "user id:weight" pairs, e.g. "1:2,7:0.5" (everyone else has weight 1).
+app.config['SCHEDULER_SHORT_SECONDS'] = int(os.environ.get('SCHEDULER_SHORT_SECONDS', 600))
+app.config['SCHEDULER_LONG_SECONDS'] = int(os.environ.get('SCHEDULER_LONG_SECONDS', 7200))
+app.config['SCHEDULER_AGING_SECONDS'] = int(os.environ.get('SCHEDULER_AGING_SECONDS', 300))
+app.config['SCHEDULER_USER_WEIGHTS'] = os.environ.get('SCHEDULER_USER_WEIGHTS', '')
+# Lifetime of one /events connection before the browser reconnects, so long-lived streams get rebalanced
+app.config['EVENTS_STREAM_SECONDS'] = int(os.environ.get('EVENTS_STREAM_SECONDS', 300))
+# Jobs run by other processes reach /events through the database: their progress is written this often, and each
+# web process looks for it and for their status changes this often. Only needed when jobs run outside the web
+# process, so off (0) unless RUN_DOWNLOAD_WORKERS=0; set it when several web processes run download workers.
+app.config['EVENTS_RELAY_SECONDS'] = float(os.environ.get('EVENTS_RELAY_SECONDS', 0 if app.config['RUN_DOWNLOAD_WORKERS'] else 5))
+# If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"; otherwise keep it off the public network
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# App and yt-dlp log level. yt-dlp's own debug output is only produced for jobs submitted with debug=1
+# and for a random YTDLP_DEBUG_SAMPLE_RATE share (0.0-1.0) of the others.
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+app.config['YTDLP_DEBUG_SAMPLE_RATE'] = float(os.environ.get('YTDLP_DEBUG_SAMPLE_RATE', 0))
 
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
@@ -29,9 +147,26 @@ login_manager.login_view = 'login'
 # This will create /var/data/downloads if /var/data is the persistent mount
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# WAL lets the dashboard read while workers write status updates; NORMAL sync is durable in WAL mode
+# except for the last transactions on power loss, which is fine for job status rows.
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=30000')
+    cursor.close()
+
 # --- Moved @app.after_request to global scope (Fix for "after_request" error) ---
 @app.after_request
 def add_header(response):
+    # Responses with an ETag may be stored but must be revalidated, so clients can get a cheap 304;
+    # for X-Accel-Redirect the front proxy serves the file and sets its own validators
+    if response.headers.get('ETag') or response.headers.get('X-Accel-Redirect'):
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     # This ensures no caching issues with dynamic content, important for status updates
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
@@ -39,6 +174,254 @@ def add_header(response):
     return response
 # --- End of moved section ---
 
+# --- Logging ---
+# One JSON object per line on stdout. Each line carries the correlation ids of the work it belongs to:
+# request_id for web requests (taken from X-Request-ID or generated, and echoed back in the response),
+# download_id or batch_id for background jobs. Fields passed with extra={...} become keys of the object.
+logger = logging.getLogger('downloader')
+_log_context = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else on a record came from extra={...}
+_LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(_log_context.get())
+        entry.update((key, value) for key, value in vars(record).items() if key not in _LOG_RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter())
+    for name in ('downloader', 'yt_dlp'):
+        named_logger = logging.getLogger(name)
+        named_logger.handlers = [handler]
+        named_logger.setLevel(app.config['LOG_LEVEL'])
+        named_logger.propagate = False
+
+configure_logging()
+
+# Adds correlation fields to every line logged by this thread until the block ends
+@contextmanager
+def log_context(**fields):
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+@app.before_request
+def assign_request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_RE.match(request_id) else uuid.uuid4().hex
+    _log_context.set({'request_id': g.request_id})
+
+@app.after_request
+def add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+# Server threads are reused between requests
+@app.teardown_request
+def clear_log_context(error=None):
+    _log_context.set({})
+
+# yt-dlp's 'logger' param. Its screen lines ("[generic] Extracting URL", "Destination: ...") are logged at
+# debug level. A verbose job also gets yt-dlp's [debug] output, logged at info so it shows at any LOG_LEVEL.
+class YtDlpLogger:
+    def __init__(self, verbose=False):
+        self.level = logging.INFO if verbose else logging.DEBUG
+        self.log = logging.getLogger('yt_dlp')
+
+    def debug(self, message):
+        self.log.log(self.level, message)
+
+    def info(self, message):
+        self.log.log(self.level, message)
+
+    def warning(self, message):
+        self.log.warning(message)
+
+    def error(self, message):
+        self.log.error(message)
+
+# --- Metrics ---
+# In-process counters, gauges and histograms, rendered in the Prometheus text format by /metrics.
+# Every web process keeps its own values, so scrape each process directly rather than through the
+# load balancer. Labels are kept to small fixed sets (route, stage, plan, status, upstream host); the
+# per-user scheduler counters add two series per user who has queued a job.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# name -> (type, help); also the order /metrics lists them in
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Time from the start of a request until its response body was sent.'),
+    'http_response_bytes_total': ('counter', 'Response body bytes sent, excluding files handed to the front proxy.'),
+    'download_stage_seconds': ('histogram', 'Duration of each stage of a download job.'),
+    'download_time_to_first_byte_seconds': ('histogram', 'Time from the start of a job until the first media byte arrived.'),
+    'download_fetched_bytes_total': ('counter', 'Media bytes fetched from upstream.'),
+    'download_jobs_finished_total': ('counter', 'Download jobs that reached a final status.'),
+    'download_queue_depth': ('gauge', 'Jobs waiting for a worker (download: across all processes; postprocess: in this process).'),
+    'scheduler_wait_seconds': ('histogram', 'Time jobs waited in the queue, by priority class (short, normal, long).'),
+    'scheduler_user_wait_seconds_total': ('counter', 'Time the jobs of each user waited in the queue; divide by scheduler_user_jobs_total for the mean.'),
+    'scheduler_user_jobs_total': ('counter', 'Jobs of each user handed to a worker.'),
+    'download_workers_active': ('gauge', 'Workers currently running a job.'),
+    'download_workers': ('gauge', 'Configured workers.'),
+    'download_process_cpu_seconds_total': ('counter', 'CPU seconds download processes spent on jobs, by task (fetch_media, prepare_stream, list_playlist).'),
+    'download_process_peak_rss_bytes': ('gauge', 'Largest resident set size a download process of this web process has reached.'),
+    'download_process_failures_total': ('counter', 'Jobs lost because their download process died (out of memory, crash) or timed out.'),
+    'media_cache_lookups_total': ('counter', 'Jobs by media cache result: hit (stored file), coalesced (in-flight job) or miss.'),
+    'media_cache_hit_ratio': ('gauge', 'Share of jobs that reused a stored or in-flight file instead of fetching.'),
+    'metadata_cache_lookups_total': ('counter', 'Metadata cache lookups, by result.'),
+    'metadata_cache_hit_ratio': ('gauge', 'Share of metadata lookups answered from the cache.'),
+    'metadata_cache_entries': ('gauge', 'Info dicts held in the in-process metadata cache.'),
+    'postprocess_jobs_total': ('counter', 'Stored files by output plan (store, remux, merge, encode).'),
+    'postprocess_cpu_seconds_total': ('counter', 'CPU seconds spent in ffmpeg, by output plan.'),
+    'storage_usage_bytes': ('gauge', 'Bytes of stored media files.'),
+    'storage_budget_bytes': ('gauge', 'STORAGE_BUDGET_BYTES (0 means unlimited).'),
+    'storage_files': ('gauge', 'Stored media files.'),
+    'storage_evicted_bytes_total': ('counter', 'Bytes of media files evicted to stay within the storage budget.'),
+    'disk_free_bytes': ('gauge', 'Free space on the UPLOAD_FOLDER file system.'),
+    'disk_total_bytes': ('gauge', 'Size of the UPLOAD_FOLDER file system.'),
+    'upstream_rate': ('gauge', 'Current allowed request rate per upstream host, in requests per second.'),
+    'upstream_throttled_total': ('counter', 'Throttling responses (HTTP 429/403, bot checks) per upstream host.'),
+    'upstream_wait_seconds_total': ('counter', 'Time requests waited for an upstream token, per host.'),
+    'jobs_recovered_total': ('counter', 'Jobs whose lease ran out, by what recovery did with them (requeued, failed).'),
+    'janitor_removed_dirs_total': ('counter', 'Orphaned work and temporary directories removed.'),
+    'janitor_reclaimed_bytes_total': ('counter', 'Bytes freed by removing orphaned directories.'),
+    'jobs_active': ('gauge', 'Queued and running jobs across all processes, the number MAX_ACTIVE_JOBS limits.'),
+    'admission_rejected_total': ('counter', 'Submissions refused with 429, by the limit they hit (global, user).'),
+}
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {} # name -> {labels: value}; labels is a sorted tuple of (label, value)
+        self._histograms = {} # name -> {labels: [count per bucket..., sum, count]}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    # Keeps the largest value reported, for peaks that download processes send with their results
+    def set_max(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = max(series.get(key, 0), value)
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    # Counters and histograms recorded since the last drain, for a download process to hand to the web process
+    def drain(self):
+        with self._lock:
+            values = {name: self._values.pop(name) for name in list(self._values) if METRICS[name][0] == 'counter'}
+            histograms, self._histograms = self._histograms, {}
+        return values, histograms
+
+    def merge(self, drained):
+        values, histograms = drained
+        with self._lock:
+            for name, series in values.items():
+                target = self._values.setdefault(name, {})
+                for labels, value in series.items():
+                    target[labels] = target.get(labels, 0) + value
+            for name, series in histograms.items():
+                target = self._histograms.setdefault(name, {})
+                for labels, counts in series.items():
+                    current = target.setdefault(labels, [0] * len(counts))
+                    for i, count in enumerate(counts):
+                        current[i] += count
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in METRICS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind != 'histogram':
+                    for labels, value in sorted(self._values.get(name, {}).items()):
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                for labels, counts in sorted(self._histograms.get(name, {}).items()):
+                    for bound, count in zip(DURATION_BUCKETS, counts):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {counts[-1]}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(counts[-2])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {counts[-1]}")
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = MetricsRegistry()
+
+# Request timing runs until the server has sent the whole body, so streamed ZIP exports and
+# stream-while-downloading responses are measured end to end, not just until the view returned.
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    started_at = g.get('request_started_at')
+    if started_at is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {'route': route, 'method': request.method, 'status': str(response.status_code)}
+    if response.is_streamed and response.content_length is None:
+        response.response = _count_response_bytes(response.response, route)
+    elif response.content_length and not response.headers.get('X-Accel-Redirect'):
+        metrics.inc('http_response_bytes_total', response.content_length, route=route)
+    response.call_on_close(lambda: metrics.observe('http_request_duration_seconds', time.monotonic() - started_at, **labels))
+    return response
+
+def _count_response_bytes(chunks, route):
+    try:
+        for chunk in chunks:
+            metrics.inc('http_response_bytes_total', len(chunk), route=route)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -54,9 +437,103 @@ class Download(db.Model):
     title = db.Column(db.String(200), nullable=False)
     url = db.Column(db.String(500), nullable=False)
     download_type = db.Column(db.String(10), nullable=False)  # 'video' or 'audio'
-    status = db.Column(db.String(20), default='pending')  # pending, downloading, completed, failed
+    preset = db.Column(db.String(10)) # Output format, a FORMAT_PRESETS name; NULL means the type's default
+    status = db.Column(db.String(20), default='pending')  # waiting (held back by its batch), pending, downloading, completed, failed, evicted
     filename = db.Column(db.String(200)) # This will now store the filename in UPLOAD_FOLDER
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    batch_id = db.Column(db.Integer, db.ForeignKey('download_batch.id'), index=True) # Set for playlist entries
+    error = db.Column(db.String(500)) # Why the last attempt failed
+    debug = db.Column(db.Boolean, default=False) # Log yt-dlp's debug output for this job
+    # Set while a worker has the job (see claim_download); the owning process keeps extending the lease
+    lease_owner = db.Column(db.String(100)) # host:pid
+    lease_expires_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0) # Times a worker has started this job
+    duration = db.Column(db.Integer) # Media length in seconds once known (playlist listing, extraction); decides the priority class
+    progress = db.Column(db.Text) # Newest progress event (JSON) while downloading, for /events streams of other processes
+    # Bumped on every change; /check_status uses it as its change cursor
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Every per-user page filters on user_id and orders by created_at, /check_status?since= scans by
+    # updated_at, /download_file and the media reference counting look rows up by filename, and admission
+    # control counts recently finished jobs and ranks queued ones by status and updated_at; the progress relay
+# looks for rows changed by other processes by updated_at alone
+    __table_args__ = (
+        db.Index('ix_download_user_created', 'user_id', 'created_at'),
+        db.Index('ix_download_user_updated', 'user_id', 'updated_at'),
+        db.Index('ix_download_user_filename', 'user_id', 'filename'),
+        db.Index('ix_download_filename', 'filename'),
+        db.Index('ix_download_status_lease', 'status', 'lease_expires_at'),
+        db.Index('ix_download_status_updated', 'status', 'updated_at'),
+        db.Index('ix_download_updated', 'updated_at'),
+    )
+
+# A playlist or channel submitted at once. Its entries are ordinary Download rows pointing back here;
+# the batch itself only tracks expansion and the overall outcome.
+class DownloadBatch(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    title = db.Column(db.String(200), nullable=False)
+    url = db.Column(db.String(500), nullable=False)
+    download_type = db.Column(db.String(10), nullable=False)
+    preset = db.Column(db.String(10))
+    status = db.Column(db.String(20), default='expanding')  # expanding, running, completed, partial, failed
+    total_entries = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Token bucket and adaptive rate of one upstream host (see UpstreamRateLimiter). Times are epoch seconds.
+class UpstreamHost(db.Model):
+    host = db.Column(db.String(255), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    rate = db.Column(db.Float, nullable=False) # requests per second
+    updated_at = db.Column(db.Float, nullable=False)
+    blocked_until = db.Column(db.Float, default=0.0)
+    penalized_at = db.Column(db.Float, default=0.0)
+    throttled_count = db.Column(db.Integer, default=0)
+
+# Optional persistent tier of the metadata cache (see METADATA_CACHE_SQLITE)
+class CachedInfo(db.Model):
+    key = db.Column(db.String(200), primary_key=True) # canonical extractor id, e.g. youtube:dQw4w9WgXcQ
+    info_json = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Finished media shared by every Download of the same (video, type, format preset).
+# ref_count is the number of Download rows pointing at the file; the file is deleted when it drops to zero.
+class MediaFile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(300), unique=True, nullable=False) # <video key>|<type>|<preset>
+    filename = db.Column(db.String(200), unique=True, nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    size_bytes = db.Column(db.BigInteger, default=0)
+    ref_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_accessed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True) # LRU order for storage eviction
+    # What plan_output() decided for this file and what it cost, to measure how much encoding is avoided
+    plan = db.Column(db.String(10)) # store, remux, merge or encode
+    source_codecs = db.Column(db.String(100)) # e.g. avc1.4d401f+mp4a.40.2
+    postprocess_cpu_seconds = db.Column(db.Float)
+
+# db.create_all() creates missing tables but never changes existing ones, so columns and indexes
+# added to the models later are applied here. Run it after db.create_all() when upgrading.
+def ensure_schema():
+    inspector = db.inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"))
+                logger.info("Added column", extra={'table': table.name, 'column': column.name})
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    db.session.execute(text("UPDATE download SET updated_at = created_at WHERE updated_at IS NULL"))
+    db.session.execute(text("UPDATE media_file SET last_accessed_at = created_at WHERE last_accessed_at IS NULL"))
+    db.session.commit()
+    storage_manager.index_untracked_files()
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -66,8 +543,7 @@ def load_user(user_id):
 @app.route('/')
 def index():
     if current_user.is_authenticated:
-        recent_downloads = Download.query.filter_by(user_id=current_user.id).order_by(Download.created_at.desc()).limit(5).all()
-        return render_template('dashboard.html', downloads=recent_downloads)
+        return redirect(url_for('dashboard')) # The dashboard template needs the history page and cursors
     return render_template('index.html')
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -117,144 +593,2236 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
+# Only the newest page of the history is rendered; older pages are fetched from /history as the user scrolls
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    downloads = Download.query.filter_by(user_id=current_user.id).order_by(Download.created_at.desc()).all()
-    return render_template('dashboard.html', downloads=downloads)
+    downloads, next_cursor = history_page(current_user.id)
+    latest_update = db.session.query(func.max(Download.updated_at)).filter(Download.user_id == current_user.id).scalar()
+    batches = DownloadBatch.query.filter_by(user_id=current_user.id).order_by(DownloadBatch.created_at.desc()).limit(5).all()
+    return render_template('dashboard.html', downloads=downloads,
+                           history=[serialize_download(d) for d in downloads], next_cursor=next_cursor,
+                           status_cursor=latest_update.isoformat() if latest_update else None,
+                           batches=[batch_summary(b) for b in batches])
+
+# --- Admission control ---
+# Jobs that are queued or running (pending or downloading, in any process) are capped at MAX_ACTIVE_JOBS
+# overall and MAX_USER_ACTIVE_JOBS per user. A submission over a cap is refused with 429 before anything
+# is extracted, with a Retry-After of how long the jobs in the way should take at the throughput of the
+# last few minutes. Submissions racing for the last slot can both get in, so a cap may be passed by a few.
+ACTIVE_STATUSES = ('pending', 'downloading')
+THROUGHPUT_WINDOW = timedelta(minutes=5)
+RETRY_AFTER_UNKNOWN = 60 # Nothing finished recently to estimate from
+RETRY_AFTER_MAX = 3600
+
+# (all active jobs, active jobs of user_id, users with active jobs)
+def active_job_counts(user_id):
+    return tuple(db.session.query(
+        func.count(Download.id),
+        func.coalesce(func.sum(case((Download.user_id == user_id, 1), else_=0)), 0),
+        func.count(func.distinct(Download.user_id)),
+    ).filter(Download.status.in_(ACTIVE_STATUSES)).one())
+
+# Jobs per second that workers finished, across all processes. Cache hits never reach a worker (attempts 0).
+def recent_throughput():
+    finished = db.session.query(func.count(Download.id)).filter(
+        Download.status.in_(('completed', 'failed')),
+        Download.updated_at >= datetime.utcnow() - THROUGHPUT_WINDOW,
+        Download.attempts > 0,
+    ).scalar()
+    return finished / THROUGHPUT_WINDOW.total_seconds()
 
-# MODIFIED /download route for direct synchronous download
+def estimate_wait(jobs, rate):
+    if not rate:
+        return RETRY_AFTER_UNKNOWN
+    return min(max(1, math.ceil(jobs / rate)), RETRY_AFTER_MAX)
+
+# None if user_id may submit another job, otherwise (the limit it hit, seconds until a slot should free up)
+def admission_refusal(user_id):
+    total, mine, users = active_job_counts(user_id)
+    user_limit = app.config['MAX_USER_ACTIVE_JOBS']
+    global_limit = app.config['MAX_ACTIVE_JOBS']
+    if user_limit and mine >= user_limit:
+        # The scheduler splits the workers between users with queued jobs by weight (the others counted as 1)
+        weight = user_weights().get(user_id, 1.0)
+        share = weight / (weight + users - 1)
+        return 'user', estimate_wait(mine - user_limit + 1, recent_throughput() * share)
+    if global_limit and total >= global_limit:
+        return 'global', estimate_wait(total - global_limit + 1, recent_throughput())
+    return None
+
+def refuse_submission(refusal, wants_json):
+    scope, retry_after = refusal
+    metrics.inc('admission_rejected_total', scope=scope)
+    logger.info("Refused download", extra={'scope': scope, 'retry_after': retry_after})
+    if scope == 'user':
+        message = f"You already have {app.config['MAX_USER_ACTIVE_JOBS']} downloads in progress. Try again in {retry_after} seconds."
+    else:
+        message = f"The server is busy. Try again in {retry_after} seconds."
+    if wants_json:
+        response = jsonify({'success': False, 'message': message, 'retry_after': retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    flash(message, 'error')
+    return redirect(url_for('dashboard'))
+
+# 1-based place of each matching pending job among all pending jobs in the order they became pending
+# (updated_at does not change while a job waits)
+def fifo_queue_positions(*criteria):
+    ahead = aliased(Download)
+    position = select(func.count(ahead.id)).where(
+        ahead.status == 'pending',
+        or_(ahead.updated_at < Download.updated_at, and_(ahead.updated_at == Download.updated_at, ahead.id <= Download.id)),
+    ).correlate(Download).scalar_subquery()
+    return dict(db.session.query(Download.id, position).filter(Download.status == 'pending', *criteria).all())
+
+# 1-based place of each matching pending job in the order the scheduler will hand them out. Jobs beyond the
+# SCHEDULER_CANDIDATES longest-waiting ones are not ranked, so they are placed by queue time instead.
+def queue_positions(*criteria):
+    scheduled = {job['id']: position for position, job in enumerate(download_scheduler.order(queued_jobs(), scheduler_clock()), 1)}
+    pending = [row.id for row in db.session.query(Download.id).filter(Download.status == 'pending', *criteria)]
+    positions = {download_id: scheduled[download_id] for download_id in pending if download_id in scheduled}
+    elsewhere = [download_id for download_id in pending if download_id not in scheduled]
+    if elsewhere:
+        positions.update(fifo_queue_positions(Download.id.in_(elsewhere)))
+    return positions
+
+def queue_position(download_id):
+    return queue_positions(Download.id == download_id).get(download_id)
+
+# The current user's queued jobs and their places in the queue, plus how close the limits are
+@app.route('/queue')
+@login_required
+def queue_status():
+    total, mine, _ = active_job_counts(current_user.id)
+    positions = queue_positions(Download.user_id == current_user.id)
+    return jsonify({
+        'jobs': [{'id': download_id, 'position': position}
+                 for download_id, position in sorted(positions.items(), key=lambda item: item[1])],
+        'active_jobs': total,
+        'user_active_jobs': mine,
+        'max_active_jobs': app.config['MAX_ACTIVE_JOBS'],
+        'max_user_active_jobs': app.config['MAX_USER_ACTIVE_JOBS'],
+    })
+
+# /download only records the job and hands it to the background worker pool,
+# so the request returns immediately regardless of how large the media is.
 @app.route('/download', methods=['POST'])
 @login_required
 def download():
     url = request.form.get('url') # Get from form data, not JSON
     download_type = request.form.get('type') # Get from form data, not JSON
+    stream_mode = request.form.get('mode') == 'stream' # Send the media while it is being fetched
+    playlist_mode = request.form.get('playlist') == '1' # Download every entry of a playlist or channel
+    debug = request.form.get('debug') == '1' # Log yt-dlp's debug output for this job
+    wants_json = request.accept_mimetypes.best == 'application/json'
     
     if not url:
+        if wants_json:
+            return jsonify({'success': False, 'message': 'URL is required'}), 400
         flash('URL is required', 'error')
         return redirect(url_for('dashboard')) # Redirect back to dashboard
 
-    temp_dir = None
-    download_record = None
-    final_download_path = None # To store the path to the file in the permanent UPLOAD_FOLDER
-    try:
-        # Create a temporary directory for this download
-        # It's good practice to create temp directories within a known location
-        temp_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER']) 
-        
-        # Get video info first (without downloading)
-        ydl_opts_info = {'quiet': True, 'skip_download': True}
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get('title', 'Unknown Title')
-            
-        # Generate a unique filename for the downloaded file in the temp directory
-        unique_id = str(uuid.uuid4())
-        
-        # Determine output template based on type
-        if download_type == 'audio':
-            output_template = os.path.join(temp_dir, f"{unique_id}.%(ext)s")
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': output_template,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'noplaylist': True,
-                'sleep_interval': 5,
-                'fragment_retries': 5,
-                # 'max_downloads': 1, # <--- COMMENT OUT OR REMOVE THIS LINE
-                'verbose': True,
-                'no_warnings': False,
-            }
-            download_extension = 'mp3'
-        else: # video
-            output_template = os.path.join(temp_dir, f"{unique_id}.%(ext)s")
-            ydl_opts = {
-                'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]/best',
-                'outtmpl': output_template,
-                'noplaylist': True,
-                'merge_output_format': 'mp4',
-                'sleep_interval': 5,
-                'fragment_retries': 5,
-                # 'max_downloads': 1, # <--- COMMENT OUT OR REMOVE THIS LINE
-                'verbose': True,
-                'no_warnings': False,
-            }
-            download_extension = 'mp4'
+    if download_type != 'audio':
+        download_type = 'video'
+    # An explicit preset (e.g. original-quality m4a/opus audio) also decides the type
+    preset = request.form.get('preset')
+    if preset not in FORMAT_PRESETS:
+        preset = DEFAULT_PRESETS[download_type]
+    download_type = FORMAT_PRESETS[preset]['type']
+
+    if playlist_mode:
+        refusal = admission_refusal(current_user.id)
+        if refusal:
+            return refuse_submission(refusal, wants_json)
+        batch = DownloadBatch(
+            user_id=current_user.id,
+            title=url[:200],
+            url=url,
+            download_type=download_type,
+            preset=preset,
+        )
+        db.session.add(batch)
+        db.session.commit()
+        start_batch(batch.id)
+        if wants_json:
+            return jsonify({'success': True, 'batch_id': batch.id, 'status': batch.status}), 202
+        flash('Playlist queued. Its entries will appear below as they are downloaded.', 'success')
+        return redirect(url_for('dashboard'))
 
-        # Create download record (status will be updated later)
+    # Serve an already downloaded copy straight away. Only YouTube ids are resolved here because
+    # that needs no extractor lookup; workers repeat the check for every other site.
+    video_key = youtube_video_key(url)
+    media = find_cached_media(video_key, preset) if video_key else None
+    if media:
         download_record = Download(
             user_id=current_user.id,
-            title=title,
+            title=media.title,
             url=url,
             download_type=download_type,
-            status='downloading' # Set to downloading while processing
+            preset=preset,
         )
+        attach_media(download_record, media)
         db.session.add(download_record)
-        db.session.commit() # Commit to get an ID for the record
+        db.session.commit()
+        download_finished(download_record)
+        if stream_mode:
+            return serve_media_file(os.path.join(app.config['UPLOAD_FOLDER'], media.filename), media.filename, client_download_name(download_record))
+        if wants_json:
+            return jsonify({'success': True, 'job_id': download_record.id, 'status': download_record.status, 'cached': True}), 200
+        flash('Download ready. This video was already available on the server.', 'success')
+        return redirect(url_for('dashboard'))
 
-        # Download the file synchronously
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            download_info = ydl.extract_info(url, download=True)
-            
-            # Find the actual downloaded file path in the temp_dir
-            actual_filepath_in_temp = None
-            for fname in os.listdir(temp_dir):
-                if fname.startswith(unique_id): # yt-dlp might add extra info to the filename (e.g., .f137.mp4)
-                    actual_filepath_in_temp = os.path.join(temp_dir, fname)
-                    break
-            
-            if not actual_filepath_in_temp or not os.path.exists(actual_filepath_in_temp):
-                raise Exception("Downloaded file not found or path is incorrect in temporary directory.")
-            
-            # Construct a user-friendly download name for the client
-            safe_title = "".join([c for c in title if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
-            if len(safe_title) > 100:
-                safe_title = safe_title[:100]
-            
-            # Use a unique filename for the permanently stored file to avoid conflicts
-            permanent_filename = f"{unique_id}_{safe_title}.{download_extension}"
-            final_download_path = os.path.join(app.config['UPLOAD_FOLDER'], permanent_filename)
+    # Cached copies above cost nothing, so they are served even when the queue is full
+    refusal = admission_refusal(current_user.id)
+    if refusal:
+        return refuse_submission(refusal, wants_json)
+
+    if stream_mode and shutil.which('ffmpeg'):
+        try:
+            response = stream_download(url, preset, debug)
+        except Exception as e:
+            logger.error("Streaming download failed", extra={'url': url, 'error': str(e)})
+            flash(f"Download failed: {str(e)}", 'error')
+            return redirect(url_for('dashboard'))
+        if response is not None:
+            return response
+        # Formats ffmpeg cannot read directly (e.g. DASH fragments), or a stream with every download process
+        # busy, go through the normal queue
+
+    # The real title is filled in by the worker once the metadata is extracted
+    download_record = Download(
+        user_id=current_user.id,
+        title=url[:200],
+        url=url,
+        download_type=download_type,
+        preset=preset,
+        status='pending',
+        debug=debug,
+    )
+    db.session.add(download_record)
+    db.session.commit() # Commit to get an ID for the job
+
+    wake_download_workers()
+    position = queue_position(download_record.id)
+    logger.info("Queued download", extra={'download_id': download_record.id, 'preset': preset, 'queue_position': position})
+
+    if wants_json:
+        return jsonify({'success': True, 'job_id': download_record.id, 'status': download_record.status, 'queue_position': position}), 202
+    flash(f"Download queued (position {position}). It will appear below when it is ready." if position else
+          'Download queued. It will appear below when it is ready.', 'success')
+    return redirect(url_for('dashboard'))
+
+# --- Fair-share scheduling ---
+# Queued jobs are not run first come, first served. The next job is chosen by
+#   1. priority class: short clips, then normal jobs, then long videos. A job moves up one class for every
+#      SCHEDULER_AGING_SECONDS it has waited, so long videos are held back but never starve;
+#   2. fair share: the user who has received the least service so far goes first. Service is the estimated
+#      cost of the jobs handed to workers (media seconds) divided by the user's weight, so one user's
+#      200-entry playlist gets that user's share of the workers rather than all of them;
+#   3. the time the job was queued.
+# Durations are known before a job runs for playlist entries (from the listing) and for retries and re-fetches
+# (from the earlier extraction); other jobs count as DEFAULT_JOB_COST in the normal class.
+# Every process keeps its own tally of service, so with several worker processes each one hands out its
+# share fairly and the overall split is close to fair. Only the SCHEDULER_CANDIDATES longest-waiting jobs
+# are ranked at each claim, which keeps a claim cheap however long the queue gets.
+PRIORITY_SHORT, PRIORITY_NORMAL, PRIORITY_LONG = 0, 1, 2
+PRIORITY_NAMES = ('short', 'normal', 'long')
+VIDEO_COST_FACTOR = 4 # A video job moves several times the bytes of an audio job of the same length
+DEFAULT_JOB_COST = 600
+SCHEDULER_CANDIDATES = 500
+EPOCH = datetime(1970, 1, 1)
+
+def job_cost(download_type, duration):
+    if not duration:
+        return DEFAULT_JOB_COST
+    return duration * (VIDEO_COST_FACTOR if download_type == 'video' else 1)
+
+def priority_class(download_type, duration):
+    if not duration:
+        return PRIORITY_NORMAL
+    cost = job_cost(download_type, duration)
+    if cost <= app.config['SCHEDULER_SHORT_SECONDS']:
+        return PRIORITY_SHORT
+    if cost > app.config['SCHEDULER_LONG_SECONDS']:
+        return PRIORITY_LONG
+    return PRIORITY_NORMAL
+
+# SCHEDULER_USER_WEIGHTS ("1:2,7:0.5") as {user id: weight}; malformed or non-positive pairs are ignored
+def user_weights():
+    weights = {}
+    for pair in app.config['SCHEDULER_USER_WEIGHTS'].split(','):
+        try:
+            user_id, weight = pair.split(':')
+            if float(weight) > 0:
+                weights[int(user_id)] = float(weight)
+        except ValueError:
+            continue
+    return weights
+
+# Seconds since the epoch, the clock of enqueued_at
+def scheduler_clock():
+    return (datetime.utcnow() - EPOCH).total_seconds()
+
+# A pending row as a scheduler job. updated_at is when it became pending; it does not change while it waits.
+def queued_job(row):
+    return {
+        'id': row.id,
+        'user_id': row.user_id,
+        'priority': priority_class(row.download_type, row.duration),
+        'cost': job_cost(row.download_type, row.duration),
+        'enqueued_at': (row.updated_at - EPOCH).total_seconds(),
+    }
+
+def queued_jobs():
+    rows = db.session.query(
+        Download.id, Download.user_id, Download.download_type, Download.duration, Download.updated_at,
+    ).filter(Download.status == 'pending').order_by(Download.updated_at, Download.id).limit(SCHEDULER_CANDIDATES).all()
+    return [queued_job(row) for row in rows]
+
+# Jobs are dicts with id, user_id, priority, cost and enqueued_at (see queued_job). The scheduler keeps how
+# much service each user has received; a user who had nothing queued starts level with the least served
+# waiting user, so idle time is not saved up and spent in one burst.
+class FairShareScheduler:
+    def __init__(self):
+        self._served = {} # user id -> cost / weight of the user's jobs handed out so far
+        self._floor = 0.0 # least service among users with jobs queued after the last pick
+        self._backlogged = set()
+
+    def priority(self, job, now):
+        aging = app.config['SCHEDULER_AGING_SECONDS']
+        promoted = int((now - job['enqueued_at']) // aging) if aging > 0 else 0
+        return max(PRIORITY_SHORT, job['priority'] - promoted)
+
+    def _service(self, jobs):
+        served = dict(self._served)
+        for user_id in {job['user_id'] for job in jobs} - self._backlogged:
+            served[user_id] = max(served.get(user_id, 0.0), self._floor)
+        return served
+
+    # Records that job, one of the queued jobs, was handed to a worker
+    def charge(self, job, jobs):
+        self._served = self._service(jobs)
+        self._served[job['user_id']] += job['cost'] / user_weights().get(job['user_id'], 1.0)
+        self._backlogged = {other['user_id'] for other in jobs if other['id'] != job['id']}
+        self._floor = min((self._served[user_id] for user_id in self._backlogged), default=self._served[job['user_id']])
+
+    # Yields the queued jobs in the order they would be handed out if nothing else arrived. Within one user
+    # the order only depends on class and queue time, so each step compares the users' next jobs.
+    def order(self, jobs, now):
+        served = self._service(jobs)
+        weights = user_weights()
+        per_user = {}
+        for job in reversed(sorted(jobs, key=lambda job: (self.priority(job, now), job['enqueued_at']))):
+            per_user.setdefault(job['user_id'], []).append(job) # Best job last, for pop()
+        while per_user:
+            user_id = min(per_user, key=lambda user_id: (
+                self.priority(per_user[user_id][-1], now), served[user_id], per_user[user_id][-1]['enqueued_at']))
+            job = per_user[user_id].pop()
+            if not per_user[user_id]:
+                del per_user[user_id]
+            served[user_id] += job['cost'] / weights.get(user_id, 1.0)
+            yield job
+
+download_scheduler = FairShareScheduler()
+
+# --- Background download workers ---
+# The queue is the set of pending rows in the database, shared by every process and host. Each worker thread
+# claims the job the scheduler ranks first (see claim_next_download) and runs the pipeline for it, with the
+# yt-dlp part in a download process. Web processes run workers too unless RUN_DOWNLOAD_WORKERS=0; they always
+# run the maintenance thread, which renews the leases of their streamed downloads.
+_jobs_available = threading.Event()
+_workers_started = False
+_workers_lock = threading.Lock()
+
+def start_download_workers():
+    # Started lazily on the first request or enqueue so importing A.py (flask shell, gunicorn preload) stays cheap
+    global _workers_started
+    if _workers_started:
+        return
+    with _workers_lock:
+        if _workers_started:
+            return
+        if app.config['RUN_DOWNLOAD_WORKERS']:
+            for i in range(max(1, app.config['DOWNLOAD_WORKERS'])):
+                worker = threading.Thread(target=_download_worker, name=f"download-worker-{i}", daemon=True)
+                worker.start()
+            for i in range(max(1, app.config['POSTPROCESS_WORKERS'])):
+                worker = threading.Thread(target=_postprocess_worker, name=f"postprocess-worker-{i}", daemon=True)
+                worker.start()
+        threading.Thread(target=_maintenance_loop, name="job-maintenance", daemon=True).start()
+        _workers_started = True
+
+# A restarted process picks up interrupted jobs on its first request, without waiting for a new download
+@app.before_request
+def ensure_workers_started():
+    start_download_workers()
+
+# Called once a job has been committed as pending. Workers of other processes find it on their next poll.
+def wake_download_workers():
+    start_download_workers()
+    _jobs_available.set()
+
+def _download_worker():
+    while True:
+        # Cleared before looking, so a job queued while this worker searches wakes it straight away
+        _jobs_available.clear()
+        with app.app_context():
+            try:
+                job = claim_next_download()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Could not claim a job")
+                job = None
+        if job is None:
+            _jobs_available.wait(app.config['JOB_POLL_SECONDS'])
+            continue
+        download_id = job['id']
+        waited = max(0.0, scheduler_clock() - job['enqueued_at'])
+        metrics.observe('download_stage_seconds', waited, stage='queue')
+        metrics.observe('scheduler_wait_seconds', waited, priority=PRIORITY_NAMES[job['priority']])
+        metrics.inc('scheduler_user_wait_seconds_total', waited, user=str(job['user_id']))
+        metrics.inc('scheduler_user_jobs_total', user=str(job['user_id']))
+        metrics.inc('download_workers_active', pool='download')
+        try:
+            with app.app_context(), log_context(download_id=download_id):
+                process_download(download_id)
+        except Exception:
+            logger.exception("Worker failed", extra={'download_id': download_id})
+        finally:
+            metrics.inc('download_workers_active', -1, pool='download')
 
-            # Move the downloaded file from temp_dir to the permanent UPLOAD_FOLDER
-            shutil.move(actual_filepath_in_temp, final_download_path)
-            print(f"Moved file from {actual_filepath_in_temp} to {final_download_path}")
+# A process that only downloads: `flask --app A worker`. Run any number of them, on any host that shares the
+# database and UPLOAD_FOLDER with the web processes.
+@app.cli.command('worker')
+def run_worker():
+    app.config['RUN_DOWNLOAD_WORKERS'] = True
+    # Web processes can only show these jobs' progress if it is written to the database
+    app.config['EVENTS_RELAY_SECONDS'] = float(os.environ.get('EVENTS_RELAY_SECONDS', 5))
+    start_download_workers()
+    logger.info("Download worker started", extra={'worker': worker_id(), 'threads': max(1, app.config['DOWNLOAD_WORKERS'])})
+    while True:
+        time.sleep(3600)
 
-            # Update download record status to completed and store permanent filename
-            download_record.status = 'completed'
-            download_record.filename = permanent_filename # Store the name of the file in UPLOAD_FOLDER
+# --- Download processes ---
+# yt-dlp never runs in the web process: extraction, format selection and fetching happen in child
+# processes, so extractor state, large info dicts and fragment buffers go away with the child instead
+# of piling up in a long-lived web worker. A child is replaced after DOWNLOAD_PROCESS_MAX_JOBS jobs, and
+# a job that needs more than DOWNLOAD_PROCESS_MEMORY_MB fails with MemoryError instead of growing the child.
+# Jobs return plain dicts. Progress events go through download_events; the counters and histograms a
+# child recorded come back with each result and are merged into this process's /metrics.
+PROGRESS_EVENT_INTERVAL = 0.25 # seconds between two progress ticks a child sends for the same job
+DOWNLOAD_PROCESS_KILL_GRACE = 30 # seconds a timed out child gets before it kills itself
+_download_pool = None
+_download_pool_lock = threading.Lock()
+download_events = None # multiprocessing queue read by _download_events_loop()
+
+# Every download process is a single-process executor lent to one job at a time, so no job waits inside an
+# executor, and a child that dies (OOM killer, crash) only takes the job it was running with it; a shared
+# ProcessPoolExecutor fails every running job when one of its children dies. Children are recycled here
+# rather than with max_tasks_per_child, which stalls on Python 3.11 when more jobs are queued than it has
+# processes.
+class DownloadProcessPool:
+    def __init__(self, size, context, events):
+        self.context = context
+        self.events = events
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put((None, 0)) # (executor, jobs it ran); started on first use
+
+    def _start(self):
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self.context,
+            initializer=_init_download_process,
+            initargs=(self.events, dict(app.config)),
+        )
+
+    # Waits up to `wait` seconds (None: as long as it takes) for a free download process; queue.Empty if none came
+    def run(self, func, args, log_fields, wait=None):
+        executor, jobs = self.idle.get(timeout=wait)
+        try:
+            if executor is None:
+                executor, jobs = self._start(), 0
+            timeout = app.config['DOWNLOAD_PROCESS_TIMEOUT'] or None
+            result = executor.submit(_run_in_child, func, args, log_fields).result(timeout)
+            jobs += 1
+            return result
+        except (BrokenProcessPool, FutureTimeoutError):
+            # A timed out child kills itself shortly after (see _run_in_child)
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None
+            raise
+        finally:
+            max_jobs = app.config['DOWNLOAD_PROCESS_MAX_JOBS']
+            if executor is not None and max_jobs and jobs >= max_jobs:
+                executor.shutdown(wait=False)
+                executor = None
+            self.idle.put((executor, jobs))
+
+def download_pool():
+    global _download_pool, download_events
+    with _download_pool_lock:
+        if _download_pool is None:
+            # Forking a process that runs server and worker threads can copy held locks. Children are forked
+            # from a single-threaded fork server that has imported this module instead (spawn on Windows).
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context('spawn')
+            download_events = context.Queue()
+            threading.Thread(target=_download_events_loop, name="download-events", daemon=True).start()
+            # One process more than fetch workers, so stream and playlist extractions never wait behind fetches
+            _download_pool = DownloadProcessPool(max(1, app.config['DOWNLOAD_WORKERS']) + 1, context, download_events)
+        return _download_pool
+
+def _init_download_process(events, config):
+    global download_events
+    download_events = events
+    app.config.update(config)
+    configure_logging()
+    limit = app.config['DOWNLOAD_PROCESS_MEMORY_MB'] * 1024 * 1024
+    if limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    threading.Thread(target=_exit_with_parent, name="parent-watch", daemon=True).start()
+
+# A child left running after its web process died would keep writing .part files that crash recovery
+# hands to another process, so it exits as soon as the web process is gone. (The fork server, not the web
+# process, is the OS parent; parent_process() follows the process that started the child.)
+def _exit_with_parent():
+    multiprocessing.parent_process().join()
+    os._exit(1)
+
+# Runs in a download process. Only the message of an error comes back, since not every exception
+# raised inside yt-dlp survives pickling.
+def _run_in_child(func, args, log_fields):
+    cpu_started_at = time.process_time()
+    watchdog = None
+    if app.config['DOWNLOAD_PROCESS_TIMEOUT']:
+        # The web process gives up on the job after DOWNLOAD_PROCESS_TIMEOUT; nothing can interrupt yt-dlp
+        # from outside, so the child ends itself
+        watchdog = threading.Timer(app.config['DOWNLOAD_PROCESS_TIMEOUT'] + DOWNLOAD_PROCESS_KILL_GRACE, os._exit, (1,))
+        watchdog.daemon = True
+        watchdog.start()
+    with app.app_context(), log_context(**log_fields):
+        try:
+            result = {'value': func(*args)}
+        except Exception as e:
+            result = {'error': str(e) or type(e).__name__}
+    if watchdog is not None:
+        watchdog.cancel()
+    metrics.inc('download_process_cpu_seconds_total', time.process_time() - cpu_started_at, task=func.__name__)
+    result['metrics'] = metrics.drain()
+    if resource is not None:
+        result['peak_rss_bytes'] = peak_rss_bytes()
+    return result
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# Runs func(*args) in a download process and returns its result; an error in the child is raised here as
+# Exception(message). BrokenProcessPool means the child died (OOM killer, crash) while running this job;
+# queue.Empty that no download process became free within `wait` seconds.
+def run_in_download_process(func, *args, wait=None):
+    try:
+        result = download_pool().run(func, args, _log_context.get(), wait)
+    except BrokenProcessPool:
+        metrics.inc('download_process_failures_total')
+        raise
+    except FutureTimeoutError:
+        metrics.inc('download_process_failures_total')
+        raise Exception(f"Download process did not finish within {app.config['DOWNLOAD_PROCESS_TIMEOUT']} seconds.")
+    metrics.merge(result['metrics'])
+    if 'peak_rss_bytes' in result:
+        metrics.set_max('download_process_peak_rss_bytes', result['peak_rss_bytes'])
+    if 'error' in result:
+        raise Exception(result['error'])
+    return result['value']
+
+def _download_events_loop():
+    while True:
+        kind, payload = download_events.get()
+        try:
+            if kind == 'progress':
+                publish_progress(*payload)
+            elif kind == 'fetching':
+                with app.app_context(), log_context(download_id=payload['download_id']):
+                    fetch_started(**payload)
+        except Exception:
+            logger.exception("Could not handle a download process event", extra={'kind': kind})
+
+# --- Job leases and crash recovery ---
+# A worker claims a job by moving it from pending to downloading under a lease (lease_owner, lease_expires_at)
+# in one conditional UPDATE, so a job queued twice, or by two processes, still runs once. A heartbeat in the
+# owning process keeps extending the lease. When the process dies the lease runs out, and the recovery pass
+# queues the job again. Its work directory (UPLOAD_FOLDER/.work/<download id>) is kept, so yt-dlp continues
+# the .part files it left behind instead of starting over.
+WORK_DIR_NAME = '.work'
+# Batches listing their entries longer than this are assumed to belong to a dead process
+BATCH_EXPANSION_TIMEOUT = timedelta(minutes=10)
+# Directories left in UPLOAD_FOLDER by tempfile.mkdtemp() in releases before work directories
+LEGACY_TEMP_DIR_AGE = 3600
+
+def worker_id():
+    # Looked up per call: with gunicorn --preload the module is imported before the workers fork
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def job_work_dir(download_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], WORK_DIR_NAME, str(download_id))
+
+def lease_deadline():
+    return datetime.utcnow() + timedelta(seconds=app.config['JOB_LEASE_SECONDS'])
+
+# Moves a pending job to downloading under this process's lease; False if another worker got it first
+def claim_download(download_id):
+    claimed = Download.query.filter_by(id=download_id, status='pending').update({
+        'status': 'downloading',
+        'lease_owner': worker_id(),
+        'lease_expires_at': lease_deadline(),
+        'attempts': func.coalesce(Download.attempts, 0) + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+# Claims the pending job the scheduler ranks first. If another process claimed it in the meantime, its
+# conditional UPDATE matches no row and the next job in order is tried. One claim at a time per process, so
+# its worker threads do not race each other for the same row.
+_claim_lock = threading.Lock()
+
+def claim_next_download():
+    with _claim_lock:
+        jobs = queued_jobs()
+        for job in download_scheduler.order(jobs, scheduler_clock()):
+            if claim_download(job['id']):
+                download_scheduler.charge(job, jobs)
+                return job
+    return None
+
+# Heartbeat for every job this process holds, including coalesced followers and queued postprocessing.
+# updated_at is kept as it is so a heartbeat is not a change for /check_status.
+def renew_leases():
+    renewed = Download.query.filter_by(lease_owner=worker_id(), status='downloading').update({
+        'lease_expires_at': lease_deadline(),
+        'updated_at': Download.updated_at,
+    }, synchronize_session=False)
+    db.session.commit()
+    return renewed
+
+# Jobs whose lease ran out go back to pending, or fail once they used up JOB_MAX_ATTEMPTS. Rows from
+# before leases existed count as expired once they have not changed for a lease period.
+def recover_interrupted_jobs():
+    now = datetime.utcnow()
+    stale = Download.query.filter(
+        Download.status == 'downloading',
+        or_(
+            Download.lease_expires_at < now,
+            and_(Download.lease_expires_at.is_(None),
+                 Download.updated_at < now - timedelta(seconds=app.config['JOB_LEASE_SECONDS'])),
+        ),
+    ).all()
+    recovered = []
+    for download in stale:
+        if (download.attempts or 0) >= app.config['JOB_MAX_ATTEMPTS']:
+            values = {'status': 'failed', 'lease_owner': None,
+                      'error': f"Interrupted {download.attempts} times; giving up."}
+        else:
+            values = {'status': 'pending', 'lease_owner': None}
+        # Only if nobody renewed or recovered it since it was read
+        updated = Download.query.filter_by(
+            id=download.id, status='downloading', lease_expires_at=download.lease_expires_at,
+        ).update(values, synchronize_session=False)
+        if updated:
+            recovered.append((download.id, download.lease_owner, values['status']))
+    db.session.commit()
+    for download_id, previous_owner, status in recovered:
+        download = db.session.get(Download, download_id)
+        metrics.inc('jobs_recovered_total', action='requeued' if status == 'pending' else 'failed')
+        logger.warning("Recovered interrupted job", extra={
+            'download_id': download_id, 'previous_owner': previous_owner, 'attempts': download.attempts, 'status': status,
+        })
+        if status == 'pending':
+            publish_status(download)
+            wake_download_workers()
+        else:
+            download_finished(download)
+    return len(recovered)
+
+# Pending jobs wait in the database, so the workers pick them up after a restart without help; batches
+# interrupted mid-way are continued here
+def recover_on_startup():
+    recover_interrupted_jobs()
+    pending = db.session.query(func.count(Download.id)).filter_by(status='pending').scalar()
+    stale_before = datetime.utcnow() - BATCH_EXPANSION_TIMEOUT
+    for batch in DownloadBatch.query.filter(DownloadBatch.status.in_(('expanding', 'running'))).all():
+        if batch.status == 'running':
+            advance_batch(batch.id)
+            continue
+        if batch.updated_at >= stale_before:
+            continue
+        # Bumping updated_at claims the restart, so only one process lists the entries again
+        restarted = DownloadBatch.query.filter_by(id=batch.id, status='expanding', updated_at=batch.updated_at).update(
+            {'updated_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if restarted:
+            logger.warning("Restarting interrupted batch", extra={'batch_id': batch.id})
+            start_batch(batch.id)
+    if pending:
+        wake_download_workers()
+        logger.info("Pending jobs waiting from before the restart", extra={'jobs': pending})
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _remove_orphan(path, reason):
+    size = _directory_size(path)
+    shutil.rmtree(path, ignore_errors=True)
+    metrics.inc('janitor_removed_dirs_total')
+    metrics.inc('janitor_reclaimed_bytes_total', size)
+    logger.info("Removed orphaned directory", extra={'path': path, 'reason': reason, 'size_bytes': size})
+    return size
+
+# Removes work directories of jobs that are no longer pending or downloading (their worker died after the
+# job was settled elsewhere, or the row was deleted) and temporary directories left by older releases
+def sweep_work_dirs():
+    reclaimed = 0
+    work_root = os.path.join(app.config['UPLOAD_FOLDER'], WORK_DIR_NAME)
+    entries = os.listdir(work_root) if os.path.isdir(work_root) else []
+    ids = [int(name) for name in entries if name.isdigit()]
+    active = {row.id for row in db.session.query(Download.id).filter(
+        Download.id.in_(ids), Download.status.in_(('pending', 'downloading')))} if ids else set()
+    for name in entries:
+        if name.isdigit() and int(name) in active:
+            continue
+        reclaimed += _remove_orphan(os.path.join(work_root, name), 'job not active')
+    cutoff = time.time() - LEGACY_TEMP_DIR_AGE
+    for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+        if entry.name.startswith('tmp') and entry.is_dir() and entry.stat().st_mtime < cutoff:
+            reclaimed += _remove_orphan(entry.path, 'legacy temporary directory')
+    return reclaimed
+
+def _maintenance_loop():
+    with app.app_context():
+        try:
+            recover_on_startup()
+            sweep_work_dirs()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Startup recovery failed")
+    last_sweep = time.monotonic()
+    while True:
+        time.sleep(app.config['JOB_HEARTBEAT_SECONDS'])
+        with app.app_context():
+            try:
+                renew_leases()
+                if time.monotonic() - last_sweep >= app.config['JANITOR_INTERVAL_SECONDS']:
+                    last_sweep = time.monotonic()
+                    recover_interrupted_jobs()
+                    sweep_work_dirs()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Job maintenance failed")
+
+# --- yt-dlp metadata cache ---
+# The same video arrives under many URL shapes (youtu.be, watch?v=, &t=, shorts), so the cache is keyed
+# by the canonical extractor id rather than by the raw URL. The cache lives in the web process, which outlives
+# the download processes: a cached info dict is handed to the child with its job, and one the child had to
+# extract comes back as JSON to be cached here (see run_with_cached_info). METADATA_CACHE_SQLITE shares
+# entries between web processes and restarts.
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/|live/|v/)|youtu\.be/)([0-9A-Za-z_-]{11})'
+)
+
+def _generic_key(url):
+    # Direct media links have no stable extractor id, so the URL itself identifies them
+    return 'generic:' + hashlib.sha1(url.encode('utf-8')).hexdigest()[:20]
+
+def youtube_video_key(url):
+    match = YOUTUBE_ID_RE.search(url)
+    return f"youtube:{match.group(1)}" if match else None
+
+def canonical_video_key(url):
+    video_key = youtube_video_key(url)
+    if video_key:
+        return video_key
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        temp_id = ie.get_temp_id(url)
+        if temp_id:
+            return f"{ie.ie_key().lower()}:{temp_id}"
+        break
+    return _generic_key(url)
+
+def info_cache_key(info, url):
+    # Same key space as canonical_video_key(), but taken from an already extracted info dict
+    if info.get('extractor_key') in (None, 'Generic') or not info.get('id'):
+        return _generic_key(url)
+    return f"{info['extractor_key'].lower()}:{info['id']}"
+
+class MetadataCache:
+    # In-process LRU with a per-entry TTL, bounded by entry count and by serialized size.
+    # Entries are stored as JSON so every get() hands out a fresh dict that yt-dlp is free to mutate.
+    def __init__(self, ttl, max_entries, max_bytes, persistent=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        self._entries = OrderedDict() # key -> (expires_at, info_json)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                metrics.inc('metadata_cache_lookups_total', result='hit')
+                return json.loads(entry[1])
+            if entry:
+                self._remove(key)
+        info_json = self._get_persistent(key) if self.persistent else None
+        if info_json is None:
+            metrics.inc('metadata_cache_lookups_total', result='miss')
+            return None
+        metrics.inc('metadata_cache_lookups_total', result='persistent_hit')
+        self._store(key, info_json, now + self.ttl)
+        return json.loads(info_json)
+
+    # Takes the info dict already serialized (by the download process that extracted it)
+    def put_json(self, key, info_json):
+        expires_at = time.time() + self.ttl
+        self._store(key, info_json, expires_at)
+        if self.persistent:
+            self._put_persistent(key, info_json, expires_at)
+
+    def _store(self, key, info_json, expires_at):
+        size = len(info_json)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, info_json)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, info_json = self._entries.pop(key)
+        self._bytes -= len(info_json)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    # The persistent tier needs an app context, which the download workers always have
+    def _get_persistent(self, key):
+        try:
+            row = db.session.get(CachedInfo, key)
+            if row is None:
+                return None
+            if row.expires_at <= datetime.utcnow():
+                db.session.delete(row)
+                db.session.commit()
+                return None
+            return row.info_json
+        except Exception as e:
+            db.session.rollback()
+            logger.warning("Metadata cache read failed", extra={'key': key, 'error': str(e)})
+            return None
+
+    def _put_persistent(self, key, info_json, expires_at):
+        try:
+            CachedInfo.query.filter(CachedInfo.expires_at <= datetime.utcnow()).delete()
+            db.session.merge(CachedInfo(key=key, info_json=info_json, expires_at=datetime.utcfromtimestamp(expires_at)))
             db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning("Metadata cache write failed", extra={'key': key, 'error': str(e)})
 
-            # Clean up the temporary directory immediately after moving the file
-            if temp_dir and os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                    print(f"Cleaned up temporary directory: {temp_dir}")
-                except Exception as e:
-                    print(f"Error cleaning up temporary directory {temp_dir}: {e}")
-            
-            # Send the file to the client from its permanent location
-            flash('Download completed successfully!', 'success')
-            return send_file(final_download_path, as_attachment=True, download_name=f"{safe_title}.{download_extension}")
+metadata_cache = MetadataCache(
+    app.config['METADATA_CACHE_TTL'],
+    app.config['METADATA_CACHE_MAX_ENTRIES'],
+    app.config['METADATA_CACHE_MAX_BYTES'],
+    persistent=app.config['METADATA_CACHE_SQLITE'],
+)
 
-    except Exception as e:
-        print(f"[ERROR] Download failed: {str(e)}")
-        if download_record:
+# Download process side: YoutubeDL.extract_info() unless the web process found the info dict in its cache.
+# Returns the info dict and, if it was extracted here, (cache key, info JSON) for the web process to cache.
+def extract_video_info(ydl, url, cached_info):
+    if cached_info is not None:
+        return cached_info, None
+    info = ydl.extract_info(url, download=False)
+    return info, (info_cache_key(info, url), json.dumps(yt_dlp.YoutubeDL.sanitize_info(info)))
+
+# Web process side: runs func(url, cached info dict or None, *args) in a download process and caches the info
+# dict it extracted
+def run_with_cached_info(func, url, *args, wait=None):
+    result = run_in_download_process(func, url, metadata_cache.get(canonical_video_key(url)), *args, wait=wait)
+    extracted = result.pop('extracted_info', None)
+    if extracted:
+        metadata_cache.put_json(*extracted)
+    return result
+
+# --- Upstream rate limiting ---
+# Every request yt-dlp makes takes a token from its host's bucket first. Buckets live in the database and
+# are claimed with a conditional UPDATE on updated_at, so concurrent workers in any process never spend the
+# same token twice. Rates follow AIMD: additive increase while the host is healthy, halved on throttling.
+THROTTLE_STATUSES = (403, 429)
+THROTTLE_MESSAGES = ('HTTP Error 429', 'Too Many Requests', 'not a bot', 'rate-limit')
+
+# Lock conflicts between workers are retried; other database errors (missing table, full disk) fail the request
+TRANSIENT_DB_ERRORS = ('locked', 'busy', 'could not serialize', 'deadlock')
+LIMITER_CONFLICT_TIMEOUT = 30 # seconds of back-to-back conflicts before giving up
+
+def is_transient_db_error(error):
+    message = str(getattr(error, 'orig', None) or error).lower()
+    return any(text in message for text in TRANSIENT_DB_ERRORS)
+
+class UpstreamRateLimiter:
+    def __init__(self):
+        self.table = UpstreamHost.__table__
+
+    # Blocks until a request to host is allowed; on_wait(seconds) is called before every sleep.
+    # Returns the total time waited.
+    def acquire(self, host, on_wait=None):
+        config = app.config
+        waited = 0.0
+        conflicts_since = None
+        while True:
+            now = time.time()
+            try:
+                with db.engine.begin() as conn:
+                    row = conn.execute(select(self.table).where(self.table.c.host == host)).first()
+                    if row is None:
+                        conn.execute(insert(self.table).values(
+                            host=host, tokens=config['UPSTREAM_BURST'] - 1, rate=config['UPSTREAM_RATE'],
+                            updated_at=now, blocked_until=0.0, penalized_at=0.0, throttled_count=0))
+                        return waited
+                    # The rate only recovers for time the host was not paused
+                    healthy_for = max(0.0, now - max(row.updated_at, row.blocked_until or 0.0))
+                    rate = min(config['UPSTREAM_RATE_MAX'], row.rate + config['UPSTREAM_RATE_INCREASE'] * healthy_for)
+                    tokens = min(config['UPSTREAM_BURST'], row.tokens + max(0.0, now - row.updated_at) * rate)
+                    if now >= (row.blocked_until or 0.0) and tokens >= 1:
+                        claimed = conn.execute(update(self.table).where(
+                            self.table.c.host == host, self.table.c.updated_at == row.updated_at,
+                        ).values(tokens=tokens - 1, rate=rate, updated_at=now))
+                        if claimed.rowcount == 1:
+                            return waited
+                        continue # Another worker changed the bucket first; look again
+                    delay = max((row.blocked_until or 0.0) - now, (1 - tokens) / rate)
+            except IntegrityError:
+                continue # Another worker created the bucket first
+            except OperationalError as e:
+                # SQLite refuses to upgrade a read snapshot that another writer has moved past
+                conflicts_since = conflicts_since or time.monotonic()
+                if not is_transient_db_error(e) or time.monotonic() - conflicts_since > LIMITER_CONFLICT_TIMEOUT:
+                    raise
+                time.sleep(0.01)
+                continue
+            conflicts_since = None
+            if on_wait:
+                on_wait(delay)
+            metrics.inc('upstream_wait_seconds_total', delay, host=host)
+            time.sleep(delay)
+            waited += delay
+
+    # Throttling seen on host: halve its rate (at most once per second, so a burst of failing
+    # parallel requests counts once) and pause it for retry_after seconds
+    def penalize(self, host, retry_after=None):
+        config = app.config
+        now = time.time()
+        pause = retry_after or config['UPSTREAM_PENALTY_SECONDS']
+        try:
+            with db.engine.begin() as conn:
+                row = conn.execute(select(self.table).where(self.table.c.host == host)).first()
+                if row is None:
+                    conn.execute(insert(self.table).values(
+                        host=host, tokens=0.0, rate=max(config['UPSTREAM_RATE_MIN'], config['UPSTREAM_RATE'] / 2),
+                        updated_at=now, blocked_until=now + pause, penalized_at=now, throttled_count=1))
+                    return
+                rate = row.rate if now - (row.penalized_at or 0.0) < 1 else max(config['UPSTREAM_RATE_MIN'], row.rate / 2)
+                conn.execute(update(self.table).where(self.table.c.host == host).values(
+                    tokens=0.0, rate=rate, updated_at=now, penalized_at=now,
+                    blocked_until=max(row.blocked_until or 0.0, now + pause),
+                    throttled_count=(row.throttled_count or 0) + 1))
+        except (IntegrityError, OperationalError) as e:
+            logger.error("Could not record throttling", extra={'host': host, 'error': str(e)})
+            return
+        logger.warning("Upstream host throttled us", extra={'host': host, 'pause_seconds': pause})
+
+    def stats(self):
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(self.table)).all()
+        return {row.host: {'rate': round(row.rate, 3), 'tokens': round(row.tokens, 2),
+                           'blocked_until': row.blocked_until, 'throttled_count': row.throttled_count} for row in rows}
+
+upstream_limiter = UpstreamRateLimiter()
+
+def is_throttle_error(error):
+    return any(marker in str(error) for marker in THROTTLE_MESSAGES)
+
+# YoutubeDL whose every HTTP request (extractor pages and APIs, media and fragments) passes the limiter.
+# Set the 'rate_limit_wait_hook' param to be told when a request has to wait.
+class RateLimitedYoutubeDL(yt_dlp.YoutubeDL):
+    def urlopen(self, req):
+        url = req if isinstance(req, str) else getattr(req, 'url', None) or req.get_full_url()
+        host = urlparse(url).hostname or ''
+        on_wait = self.params.get('rate_limit_wait_hook')
+        wait_hook = (lambda delay: on_wait(host, delay)) if on_wait else None
+        # A throttled request is retried once, after the penalty block has passed
+        for attempt in range(2):
+            upstream_limiter.acquire(host, on_wait=wait_hook)
+            try:
+                return super().urlopen(req)
+            except UpstreamHTTPError as e:
+                if e.status not in THROTTLE_STATUSES:
+                    raise
+                retry_after = e.response.headers.get('Retry-After', '')
+                upstream_limiter.penalize(host, float(retry_after) if retry_after.isdigit() else None)
+                if attempt:
+                    raise
+
+# --- Content-addressed media cache ---
+# Output presets. 'cache' is part of the media cache key: bump it whenever what a preset produces
+# changes, so files made with the old settings are no longer reused. 'copy_codecs' are source audio
+# codecs that can be kept as they are; anything else is encoded with 'encode'.
+FORMAT_PRESETS = {
+    'mp3': {
+        'type': 'audio',
+        'cache': 'mp3-192k',
+        'extension': 'mp3',
+        'format': 'bestaudio/best',
+        'copy_codecs': ('mp3',),
+        'encode': ['-c:a', 'libmp3lame', '-b:a', '192k'],
+        'file_args': [],
+        'stream_args': ['-f', 'mp3'],
+    },
+    'm4a': {
+        'type': 'audio',
+        'cache': 'm4a-original',
+        'extension': 'm4a',
+        'format': 'bestaudio[acodec^=mp4a]/bestaudio[ext=m4a]/bestaudio/best',
+        'copy_codecs': ('mp4a', 'aac'),
+        'encode': ['-c:a', 'aac', '-b:a', '192k'],
+        'file_args': ['-movflags', '+faststart'],
+        'stream_args': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov'],
+    },
+    'opus': {
+        'type': 'audio',
+        'cache': 'opus-original',
+        'extension': 'opus',
+        'format': 'bestaudio[acodec=opus]/bestaudio/best',
+        'copy_codecs': ('opus',),
+        'encode': ['-c:a', 'libopus', '-b:a', '128k'],
+        'file_args': [],
+        'stream_args': ['-f', 'opus'],
+    },
+    'mp4': {
+        'type': 'video',
+        'cache': 'mp4-720p',
+        'extension': 'mp4',
+        'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]/best',
+        'file_args': ['-movflags', '+faststart'],
+        # Fragmented MP4 needs no seekable output, so playback can start before the file is complete
+        'stream_args': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov'],
+    },
+}
+DEFAULT_PRESETS = {'audio': 'mp3', 'video': 'mp4'}
+# Extractors without codec information (plain file links) still name the container
+CODEC_BY_EXTENSION = {'mp3': 'mp3', 'm4a': 'mp4a', 'opus': 'opus'}
+
+def download_preset(record):
+    return record.preset or DEFAULT_PRESETS[record.download_type]
+
+def media_cache_key(video_key, preset):
+    return f"{video_key}|{FORMAT_PRESETS[preset]['type']}|{FORMAT_PRESETS[preset]['cache']}"
+
+def find_cached_media(video_key, preset):
+    media = MediaFile.query.filter_by(cache_key=media_cache_key(video_key, preset)).first()
+    if media and not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], media.filename)):
+        # The file was removed behind our back; forget it so the next request downloads it again
+        db.session.delete(media)
+        db.session.commit()
+        return None
+    return media
+
+def attach_media(download_record, media):
+    download_record.title = media.title
+    download_record.filename = media.filename
+    download_record.status = 'completed'
+    if media.id is None:
+        media.ref_count = (media.ref_count or 0) + 1 # Not stored yet, so nobody else can count it
+        return
+    # Counted in SQL: concurrent cache hits on the same file would lose increments done in Python
+    MediaFile.query.filter_by(id=media.id).update(
+        {'ref_count': func.coalesce(MediaFile.ref_count, 0) + 1}, synchronize_session=False)
+    db.session.expire(media, ['ref_count'])
+
+# Drop one reference to a stored file and delete it once no Download uses it any more
+def release_media(filename):
+    media = MediaFile.query.filter_by(filename=filename).first()
+    if media:
+        MediaFile.query.filter_by(id=media.id).update(
+            {'ref_count': func.coalesce(MediaFile.ref_count, 0) - 1}, synchronize_session=False)
+        # The UPDATE holds the row (the database on SQLite) until commit, so this is the count others see
+        remaining = db.session.query(MediaFile.ref_count).filter_by(id=media.id).scalar()
+        if remaining > 0:
+            db.session.expire(media, ['ref_count'])
+            return
+        MediaFile.query.filter_by(id=media.id).delete(synchronize_session=False)
+        db.session.expunge(media)
+    elif Download.query.filter_by(filename=filename).count() > 1:
+        return # File from before the media cache, still used by another row
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        logger.info("Deleted unreferenced file", extra={'file': filename})
+
+# --- Storage budget and per-user quotas ---
+# Sizes and last-access times live on MediaFile. Going over the global budget evicts whole files (LRU);
+# going over a user's quota evicts that user's least recently used downloads, which only deletes the
+# file once no other user references it. Evicted rows keep their URL so they can be fetched again.
+class StorageManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.evicted_downloads = 0
+
+    def total_usage(self):
+        return db.session.query(func.coalesce(func.sum(MediaFile.size_bytes), 0)).scalar()
+
+    def user_usage(self, user_id):
+        return db.session.query(func.coalesce(func.sum(MediaFile.size_bytes), 0)).filter(
+            MediaFile.filename.in_(
+                db.session.query(Download.filename).filter(Download.user_id == user_id, Download.status == 'completed')
+            )
+        ).scalar()
+
+    def touch(self, *filenames):
+        # One write per minute and file is enough for LRU ordering
+        MediaFile.query.filter(
+            MediaFile.filename.in_(filenames),
+            MediaFile.last_accessed_at < datetime.utcnow() - timedelta(minutes=1),
+        ).update({'last_accessed_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+    # Evict until the user's quota and the global budget (minus incoming_bytes about to be written) hold.
+    # keep_filename is never evicted, so a fresh download is not thrown away right after it finished.
+    def enforce(self, user_id=None, incoming_bytes=0, keep_filename=None):
+        with self._lock:
+            quota = app.config['USER_QUOTA_BYTES']
+            if user_id is not None and quota:
+                usage = self.user_usage(user_id)
+                if usage > quota:
+                    candidates = db.session.query(Download, MediaFile).join(
+                        MediaFile, MediaFile.filename == Download.filename
+                    ).filter(
+                        Download.user_id == user_id, Download.status == 'completed', Download.filename != keep_filename
+                    ).order_by(MediaFile.last_accessed_at).all()
+                    for download, media in candidates:
+                        if usage <= quota:
+                            break
+                        usage -= media.size_bytes or 0
+                        self._evict_download(download)
+
+            budget = app.config['STORAGE_BUDGET_BYTES']
+            if budget:
+                usage = self.total_usage() + incoming_bytes
+                if usage > budget:
+                    candidates = MediaFile.query.filter(MediaFile.filename != keep_filename).order_by(MediaFile.last_accessed_at).all()
+                    for media in candidates:
+                        if usage <= budget:
+                            break
+                        usage -= media.size_bytes or 0
+                        self._evict_file(media)
+
+    def _evict_download(self, download):
+        filename = download.filename
+        download.status = 'evicted'
+        download.filename = None
+        release_media(filename)
+        db.session.commit()
+        self.evicted_downloads += 1
+        publish_status(download)
+        logger.info("Evicted download to stay within quota",
+                    extra={'evicted_download_id': download.id, 'user_id': download.user_id, 'file': filename})
+
+    def _evict_file(self, media):
+        downloads = Download.query.filter_by(filename=media.filename).all()
+        for download in downloads:
+            download.status = 'evicted'
+            download.filename = None
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], media.filename)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        db.session.delete(media)
+        db.session.commit()
+        self.evicted_files += 1
+        self.evicted_bytes += media.size_bytes or 0
+        self.evicted_downloads += len(downloads)
+        for download in downloads:
+            publish_status(download)
+        logger.info("Evicted file to stay within the storage budget", extra={'file': media.filename, 'size_bytes': media.size_bytes})
+
+    # Files completed before the media cache existed have no MediaFile row; index them so they
+    # count towards usage and can be evicted
+    def index_untracked_files(self):
+        tracked = db.session.query(MediaFile.filename)
+        rows = db.session.query(Download.filename, Download.title, func.count(Download.id)).filter(
+            Download.status == 'completed', Download.filename.isnot(None), Download.filename.notin_(tracked)
+        ).group_by(Download.filename, Download.title).all()
+        for filename, title, ref_count in rows:
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            if not os.path.exists(file_path):
+                continue
+            db.session.add(MediaFile(
+                cache_key=f"untracked:{filename}",
+                filename=filename,
+                title=title,
+                size_bytes=os.path.getsize(file_path),
+                ref_count=ref_count,
+            ))
+        db.session.commit()
+
+    def stats(self):
+        return {
+            'usage_bytes': self.total_usage(),
+            'budget_bytes': app.config['STORAGE_BUDGET_BYTES'],
+            'files': MediaFile.query.count(),
+            'evicted_files': self.evicted_files,
+            'evicted_bytes': self.evicted_bytes,
+            'evicted_downloads': self.evicted_downloads,
+        }
+
+storage_manager = StorageManager()
+
+# Every path that ends a job goes through here: notify the dashboard, then keep the owner within quota
+def download_finished(download_record):
+    metrics.inc('download_jobs_finished_total', status=download_record.status)
+    publish_status(download_record)
+    if download_record.status == 'completed':
+        try:
+            storage_manager.enforce(download_record.user_id, keep_filename=download_record.filename)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Storage enforcement failed", extra={'error': str(e)})
+    # A finished playlist entry frees a slot for the next one
+    if download_record.batch_id:
+        try:
+            advance_batch(download_record.batch_id)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Could not advance batch", extra={'batch_id': download_record.batch_id, 'error': str(e)})
+
+# --- Single-flight for identical downloads ---
+# The first job for a media key does the work; jobs for the same key that arrive while it runs
+# attach as followers and receive the same file when it finishes.
+class SingleFlight:
+    def __init__(self):
+        self._flights = {} # media key -> [(download id, user id)] of the followers
+        self._lock = threading.Lock()
+
+    # Returns True if the caller is the leader and must do the work
+    def join(self, key, download_id, user_id):
+        with self._lock:
+            if key in self._flights:
+                self._flights[key].append((download_id, user_id))
+                return False
+            self._flights[key] = []
+            return True
+
+    def followers(self, key):
+        with self._lock:
+            return list(self._flights.get(key, ()))
+
+    def finish(self, key):
+        with self._lock:
+            return self._flights.pop(key, [])
+
+in_flight = SingleFlight()
+
+# --- Live progress events ---
+# Workers publish the latest state of each job here and /events streams it to the owner's dashboard.
+# Only the newest event per job is kept, so nothing grows with the number of progress ticks and
+# the database is only written on real status changes.
+class ProgressBroker:
+    def __init__(self, min_interval=0.5, retention=300):
+        self.min_interval = min_interval # seconds between two progress ticks of the same job
+        self.retention = retention # seconds a finished job's last event is kept for reconnecting clients
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._user_seq = {} # user id -> seq of that user's newest event
+        self._events = {} # user id -> {download id: (seq, published_at, event)}
+
+    def publish(self, user_id, download_id, event, tick=False):
+        now = time.monotonic()
+        with self._cond:
+            jobs = self._events.setdefault(user_id, {})
+            previous = jobs.get(download_id)
+            if tick and previous and previous[2].get('stage') == event.get('stage') and now - previous[1] < self.min_interval:
+                return
+            self._seq += 1
+            jobs[download_id] = (self._seq, now, dict(event, id=download_id))
+            self._user_seq[user_id] = self._seq
+            if event.get('status') in ('completed', 'failed', 'partial'):
+                self._prune(now)
+            self._cond.notify_all()
+
+    # Blocks until the user has events newer than after_seq, or the timeout passes.
+    # Returns (events, newest seq); a seq from another process or a restart starts over from a snapshot.
+    def wait(self, user_id, after_seq, timeout):
+        with self._cond:
+            if after_seq > self._seq:
+                after_seq = 0
+            self._cond.wait_for(lambda: self._user_seq.get(user_id, 0) > after_seq, timeout)
+            jobs = self._events.get(user_id, {})
+            events = sorted((seq, event) for seq, _, event in jobs.values() if seq > after_seq)
+            return [event for _, event in events], max(after_seq, self._user_seq.get(user_id, 0))
+
+    def _prune(self, now):
+        for user_id, jobs in list(self._events.items()):
+            for download_id, (_, published_at, event) in list(jobs.items()):
+                if event.get('status') in ('completed', 'failed', 'partial') and now - published_at > self.retention:
+                    del jobs[download_id]
+            if not jobs:
+                del self._events[user_id]
+
+progress_broker = ProgressBroker()
+
+def status_event(download_record):
+    return {
+        'status': download_record.status,
+        'title': download_record.title,
+        'type': download_record.download_type,
+        'filename': download_record.filename,
+    }
+
+def publish_status(download_record):
+    progress_broker.publish(download_record.user_id, download_record.id, status_event(download_record))
+    if download_record.status in ('completed', 'failed', 'partial'):
+        progress_relay.forget(download_record.id)
+
+# Progress ticks from yt-dlp hooks go to the leader and to every job coalesced onto it
+def publish_progress(download_id, user_id, flight_key, event):
+    progress_broker.publish(user_id, download_id, event, tick=True)
+    download_ids = [download_id]
+    for follower_id, follower_user_id in in_flight.followers(flight_key):
+        progress_broker.publish(follower_user_id, follower_id, event, tick=True)
+        download_ids.append(follower_id)
+    progress_relay.publish(download_ids, event)
+
+# The broker only reaches /events streams of this process. When jobs also run elsewhere (`flask worker`
+# processes, several web processes), the process running a job writes its newest event to the job's row, at
+# most every EVENTS_RELAY_SECONDS and at each new stage, without bumping updated_at. Each web process reads
+# back what the others wrote in one thread and publishes it to its own broker, so streams never query the
+# database and idle ones cost nothing. Best effort: a lost write only delays the progress text.
+class ProgressRelay:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._written = {} # download id -> (monotonic time, stage) of its last write
+        self._reader_started = False
+
+    def publish(self, download_ids, event):
+        interval = app.config['EVENTS_RELAY_SECONDS']
+        if not interval:
+            return
+        now = time.monotonic()
+        with self._lock:
+            due = []
+            for download_id in download_ids:
+                written_at, stage = self._written.get(download_id, (None, None))
+                if written_at is None or now - written_at >= interval or stage != event.get('stage'):
+                    self._written[download_id] = (now, event.get('stage'))
+                    due.append(download_id)
+        if not due:
+            return
+        try:
+            with app.app_context():
+                Download.query.filter(Download.id.in_(due), Download.status == 'downloading').update(
+                    {'progress': json.dumps(event), 'updated_at': Download.updated_at}, synchronize_session=False)
+                db.session.commit()
+        except Exception:
+            logger.warning("Could not relay progress", exc_info=True, extra={'download_ids': due})
+
+    def forget(self, download_id):
+        with self._lock:
+            self._written.pop(download_id, None)
+
+    # Started by the first /events request, so worker-only processes never read
+    def start_reader(self):
+        if not app.config['EVENTS_RELAY_SECONDS'] or self._reader_started:
+            return
+        with self._lock:
+            if self._reader_started:
+                return
+            self._reader_started = True
+        threading.Thread(target=self._read_loop, name="progress-relay", daemon=True).start()
+
+    def _read_loop(self):
+        since = datetime.utcnow()
+        statuses = {} # download id -> updated_at of the status last published
+        progress = {} # download id -> progress JSON last published
+        while True:
+            time.sleep(app.config['EVENTS_RELAY_SECONDS'])
+            try:
+                with app.app_context():
+                    since = self._read(since, statuses, progress)
+            except Exception:
+                logger.warning("Could not read relayed progress", exc_info=True)
+
+    # Jobs of this process already reached the broker directly, so only rows leased by others are read:
+    # status changes by updated_at (with the overlap /check_status uses) and new progress of running jobs
+    def _read(self, since, statuses, progress):
+        elsewhere = Download.lease_owner != worker_id()
+        changed = Download.query.filter(elsewhere, Download.updated_at > since - CHECK_STATUS_OVERLAP) \
+            .order_by(Download.updated_at).all()
+        for download in changed:
+            since = max(since, download.updated_at)
+            if statuses.get(download.id) != download.updated_at:
+                statuses[download.id] = download.updated_at
+                progress_broker.publish(download.user_id, download.id, status_event(download))
+        for download_id, updated_at in list(statuses.items()):
+            if updated_at < since - CHECK_STATUS_OVERLAP:
+                del statuses[download_id]
+        running = Download.query.with_entities(Download.id, Download.user_id, Download.progress) \
+            .filter(Download.status == 'downloading', elsewhere, Download.progress.isnot(None)).all()
+        current = {}
+        for download_id, user_id, event in running:
+            current[download_id] = event
+            if progress.get(download_id) != event:
+                progress_broker.publish(user_id, download_id, json.loads(event), tick=True)
+        progress.clear()
+        progress.update(current)
+        return since
+
+progress_relay = ProgressRelay()
+
+# yt-dlp options for a FORMAT_PRESETS entry; returns the options and the final file extension.
+# yt-dlp only selects and fetches formats; whatever conversion is still needed is decided by
+# plan_output() and run by the postprocess stage. Its output goes through YtDlpLogger; progress
+# reaches the dashboard through progress hooks, so the progress bar itself is off.
+def build_ydl_opts(preset, output_template, verbose=False):
+    ydl_opts = {
+        'format': FORMAT_PRESETS[preset]['format'],
+        'outtmpl': output_template,
+        'noplaylist': True,
+        'fragment_retries': 5,
+        # 'max_downloads': 1, # <--- COMMENT OUT OR REMOVE THIS LINE
+        'verbose': verbose,
+        'no_warnings': False,
+        'noprogress': True,
+        'logger': YtDlpLogger(verbose),
+    }
+    return ydl_opts, FORMAT_PRESETS[preset]['extension']
+
+# Download every selected format of an already selected info dict into temp_dir and return the paths.
+# ydl.dl() is the per-format step of yt-dlp's own process_info(): protocol-specific downloader,
+# retries and progress hooks, but no postprocessors. File names only depend on name and the format,
+# so a retried job finds the .part files (and fragment state) of the interrupted attempt and continues them.
+def fetch_formats(ydl, info, temp_dir, name):
+    paths = []
+    for fmt in info.get('requested_formats') or [info]:
+        format_info = dict(info)
+        format_info.pop('requested_formats', None)
+        format_info.update(fmt)
+        path = os.path.join(temp_dir, f"{name}.f{fmt.get('format_id', 'best')}.{fmt.get('ext') or 'bin'}")
+        ydl.dl(path, format_info)
+        if not os.path.exists(path):
+            raise Exception(f"Format {fmt.get('format_id')} was not downloaded.")
+        paths.append(path)
+    return paths
+
+# Decides how the selected formats become the preset's output with the least work:
+#   store  - the single fetched file already is the output
+#   remux  - the streams are copied into the preset's container, or the container needs a fixup
+#   merge  - separate video and audio streams are copied into one container
+#   encode - the source audio codec is not acceptable and has to be re-encoded
+# Returns the plan and the ffmpeg codec arguments (None for 'store').
+def plan_output(preset, formats):
+    settings = FORMAT_PRESETS[preset]
+    # ADTS AAC from an MPEG-TS source is not valid in the MP4 family of containers
+    fixup_args = []
+    if settings['extension'] in ('mp4', 'm4a') and any(is_hls(f) and audio_codec(f) in ('mp4a', 'aac') for f in formats):
+        fixup_args = ['-bsf:a', 'aac_adtstoasc']
+    if settings['type'] == 'video':
+        if len(formats) > 1:
+            return 'merge', ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy'] + fixup_args
+        if formats[0].get('ext') == settings['extension'] and not needs_container_fixup(formats[0]):
+            return 'store', None
+        return 'remux', ['-c', 'copy'] + fixup_args
+    source = formats[0]
+    if audio_codec(source) in settings['copy_codecs']:
+        if (source.get('ext') == settings['extension'] and source.get('vcodec') in (None, 'none')
+                and not needs_container_fixup(source)):
+            return 'store', None
+        return 'remux', ['-vn', '-c:a', 'copy'] + fixup_args
+    return 'encode', ['-vn'] + settings['encode']
+
+def audio_codec(fmt):
+    return (fmt.get('acodec') or '').split('.')[0] or CODEC_BY_EXTENSION.get(fmt.get('ext'))
+
+def is_hls(fmt):
+    return (fmt.get('protocol') or '').startswith('m3u8')
+
+# fetch_formats() skips the fixups of yt-dlp's process_info(): DASH audio arrives in a bare fragmented
+# container (m4a_dash) and HLS as MPEG-TS whatever its ext says, so neither may be stored as it is
+def needs_container_fixup(fmt):
+    return fmt.get('container') == 'm4a_dash' or is_hls(fmt)
+
+def source_codecs(formats):
+    codecs = [f.get('acodec') if f.get('vcodec') in (None, 'none') else f.get('vcodec') for f in formats]
+    return '+'.join(codec or 'unknown' for codec in codecs)[:100]
+
+# ffmpeg command writing the preset's file from the fetched inputs (output path appended by the caller)
+def build_postprocess_command(preset, input_paths, codec_args):
+    command = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y']
+    for path in input_paths:
+        command += ['-i', path]
+    return command + codec_args + FORMAT_PRESETS[preset]['file_args']
+
+# Runs ffmpeg; returns the exit code, its stderr and the CPU seconds it used (None where os.wait4 is missing)
+def run_ffmpeg(command):
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    process.stderr.close()
+    if not hasattr(os, 'wait4'):
+        return process.wait(), stderr, None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, stderr, usage.ru_utime + usage.ru_stime
+
+# A download process found nothing stored and starts fetching: show the real title and free space
+# for the expected file while the first bytes arrive, instead of failing with ENOSPC halfway
+# The duration is kept so a retry or re-fetch of the job is scheduled in the right priority class
+def fetch_started(download_id, title, expected_bytes, duration):
+    values = {'title': title[:200]}
+    if duration:
+        values['duration'] = int(duration)
+    Download.query.filter_by(id=download_id).update(values, synchronize_session=False)
+    db.session.commit()
+    storage_manager.enforce(incoming_bytes=expected_bytes)
+
+# Download process side of process_download(): extract the metadata, look for stored media once more under
+# the extractor's id, then fetch the selected formats into the job's work directory. Only file paths and the
+# output plan come back, and the info dict as JSON for the metadata cache when it had to be extracted.
+def fetch_media(url, cached_info, spec):
+    download_id, user_id, flight_key = spec['download_id'], spec['user_id'], spec['flight_key']
+    output_template = os.path.join(spec['temp_dir'], f"{spec['unique_id']}.%(ext)s")
+    ydl_opts, _ = build_ydl_opts(spec['preset'], output_template, spec['verbose'])
+
+    # Record when the first media byte arrives so time-to-first-byte can be compared between releases
+    first_byte_at = []
+    last_tick = [0.0]
+    def progress_hook(d):
+        if d.get('status') != 'downloading':
+            return
+        now = time.monotonic()
+        if not first_byte_at and d.get('downloaded_bytes'):
+            first_byte_at.append(now)
+        if now - last_tick[0] < PROGRESS_EVENT_INTERVAL:
+            return
+        last_tick[0] = now
+        download_events.put(('progress', (download_id, user_id, flight_key, {
+            'status': 'downloading',
+            'stage': 'download',
+            'downloaded_bytes': d.get('downloaded_bytes'),
+            'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+        })))
+    def rate_limit_wait_hook(host, delay):
+        download_events.put(('progress', (download_id, user_id, flight_key, {
+            'status': 'downloading',
+            'stage': 'throttled',
+            'host': host,
+            'wait': round(delay, 1),
+        })))
+    ydl_opts['progress_hooks'] = [progress_hook]
+    ydl_opts['rate_limit_wait_hook'] = rate_limit_wait_hook
+
+    # Extract the metadata once and feed the same info dict into format selection and the fetch,
+    # instead of resolving the page, player JS and formats a second time.
+    started_at = time.monotonic()
+    with RateLimitedYoutubeDL(ydl_opts) as ydl:
+        info, extracted_info = extract_video_info(ydl, url, cached_info)
+        extracted_at = time.monotonic()
+        title = info.get('title', 'Unknown Title')
+
+        # The URL shape may have hidden a video we already have; the extractor id is authoritative
+        video_key = info_cache_key(info, url)
+        if spec['check_media_cache'] and find_cached_media(video_key, spec['preset']):
+            return {'cached': True, 'title': title, 'video_key': video_key, 'extracted_info': extracted_info}
+        download_events.put(('fetching', {
+            'download_id': download_id,
+            'title': title,
+            'expected_bytes': info.get('filesize') or info.get('filesize_approx') or 0,
+            'duration': info.get('duration'),
+        }))
+
+        # Cached info dicts carry the format chosen for another download type, so select again
+        info = ydl.process_ie_result(info, download=False)
+        formats = info.get('requested_formats') or [info]
+        plan, codec_args = plan_output(spec['preset'], formats)
+        input_paths = fetch_formats(ydl, info, spec['temp_dir'], 'source')
+
+    metrics.observe('download_stage_seconds', extracted_at - started_at, stage='extract')
+    metrics.observe('download_stage_seconds', time.monotonic() - extracted_at, stage='fetch')
+    if first_byte_at:
+        metrics.observe('download_time_to_first_byte_seconds', first_byte_at[0] - started_at)
+    metrics.inc('download_fetched_bytes_total', sum(os.path.getsize(path) for path in input_paths))
+    logger.info("Fetched", extra={
+        'extract_seconds': round(extracted_at - started_at, 3),
+        'metadata_cache': 'miss' if extracted_info else 'hit',
+        'first_byte_seconds': round(first_byte_at[0] - started_at, 3) if first_byte_at else None,
+        'fetch_seconds': round(time.monotonic() - started_at, 3),
+    })
+    return {
+        'cached': False,
+        'title': title,
+        'video_key': video_key,
+        'inputs': input_paths,
+        'plan': plan,
+        'codec_args': codec_args,
+        'source_codecs': source_codecs(formats),
+        'extracted_info': extracted_info,
+    }
+
+# Runs a job this process has claimed (see claim_next_download)
+# Finishes a job with media that is already stored, without fetching anything
+def complete_from_cache(download_record, media):
+    attach_media(download_record, media)
+    db.session.commit()
+    metrics.inc('media_cache_lookups_total', result='hit')
+    download_finished(download_record)
+    logger.info("Served from media cache", extra={'file': media.filename})
+
+def process_download(download_id):
+    download_record = db.session.get(Download, download_id)
+
+    url = download_record.url
+    preset = download_preset(download_record)
+    temp_dir = None
+    flight_key = None
+    try:
+        # Nothing to fetch if the same video was already stored under this download type
+        video_key = canonical_video_key(url)
+        media = find_cached_media(video_key, preset)
+        if media:
+            complete_from_cache(download_record, media)
+            return
+
+        publish_status(download_record)
+
+        # If the same video and type is already being fetched, wait for that job instead of starting another
+        if not in_flight.join(media_cache_key(video_key, preset), download_id, download_record.user_id):
+            metrics.inc('media_cache_lookups_total', result='coalesced')
+            logger.info("Attached to the in-flight job", extra={'video_key': video_key})
+            return
+        flight_key = media_cache_key(video_key, preset)
+
+        # The previous leader may have finished between the cache check and join()
+        media = find_cached_media(video_key, preset)
+        if media:
+            complete_from_cache(download_record, media)
+            return
+
+        # The job's work directory outlives a crash of this process, so a retry resumes what was fetched
+        temp_dir = job_work_dir(download_id)
+        os.makedirs(temp_dir, exist_ok=True)
+        
+        # Generate a unique filename for the downloaded file in the temp directory
+        unique_id = str(uuid.uuid4())
+        user_id = download_record.user_id
+        spec = {
+            'download_id': download_id,
+            'user_id': user_id,
+            'flight_key': flight_key,
+            'preset': preset,
+            'temp_dir': temp_dir,
+            'unique_id': unique_id,
+            'verbose': bool(download_record.debug) or random.random() < app.config['YTDLP_DEBUG_SAMPLE_RATE'],
+            'check_media_cache': True,
+        }
+        job_started_at = time.monotonic()
+        fetched = run_with_cached_info(fetch_media, url, spec)
+        video_key = fetched['video_key']
+        title = fetched['title']
+        if fetched['cached']:
+            media = find_cached_media(video_key, preset)
+            if media:
+                download_record.title = title[:200]
+                complete_from_cache(download_record, media)
+                return
+            # Evicted again between the two lookups
+            fetched = run_with_cached_info(fetch_media, url, dict(spec, check_media_cache=False))
+        metrics.inc('media_cache_lookups_total', result='miss')
+        input_paths = fetched['inputs']
+        plan = fetched['plan']
+        download_extension = FORMAT_PRESETS[preset]['extension']
+
+        job = {
+            'download_id': download_id,
+            'user_id': user_id,
+            'flight_key': flight_key,
+            'video_key': video_key,
+            'preset': preset,
+            'title': title,
+            'temp_dir': temp_dir,
+            'unique_id': unique_id,
+            'extension': download_extension,
+            'inputs': input_paths,
+            'plan': plan,
+            'source_codecs': fetched['source_codecs'],
+            'command': build_postprocess_command(preset, input_paths, fetched['codec_args']) if fetched['codec_args'] else None,
+            'started_at': job_started_at,
+            'queued_at': time.monotonic(),
+        }
+        # From here on the postprocess stage owns the temporary directory and the flight
+        temp_dir = None
+        flight_key = None
+        if job['command']:
+            publish_progress(download_id, user_id, job['flight_key'], {
+                'status': 'downloading',
+                'stage': 'postprocess',
+                'postprocessor': 'queued',
+            })
+            enqueue_postprocess(job)
+        else:
+            run_postprocess(job)
+
+    except BrokenProcessPool:
+        # The child running this job died. Its .part files stay in the work directory for the next attempt,
+        # and jobs coalesced onto it go back to the queue with it.
+        db.session.rollback()
+        if download_record.attempts < app.config['JOB_MAX_ATTEMPTS']:
+            logger.warning("Download process died, queueing the job again")
+            temp_dir = None
+            requeued = [download_id]
+            if flight_key:
+                followers = [follower_id for follower_id, _ in in_flight.finish(flight_key)]
+                flight_key = None
+                # Followers were only waiting for this job, so the next claim must not count as another attempt
+                if followers:
+                    Download.query.filter(Download.id.in_(followers), Download.attempts > 0).update(
+                        {'attempts': Download.attempts - 1}, synchronize_session=False)
+                    requeued += followers
+            Download.query.filter(Download.id.in_(requeued)).update(
+                {'status': 'pending', 'lease_owner': None}, synchronize_session=False)
+            db.session.commit()
+            for job_id in requeued:
+                publish_status(db.session.get(Download, job_id))
+            wake_download_workers()
+        else:
+            logger.error("Download process died, giving up")
             download_record.status = 'failed'
+            download_record.error = f"Download process died {download_record.attempts} times; giving up."
             db.session.commit()
-        # Clean up temp directory immediately if an error occurs
+            download_finished(download_record)
+    except Exception as e:
+        logger.error("Download failed", extra={'error': str(e)})
+        db.session.rollback()
+        # Bot checks and rate-limit pages arrive as extractor errors rather than HTTP statuses
+        if is_throttle_error(e):
+            upstream_limiter.penalize(urlparse(url).hostname or '')
+        download_record.status = 'failed'
+        download_record.error = str(e)[:500]
+        db.session.commit()
+        download_finished(download_record)
+    finally:
+        # Clean up the temporary directory unless the job was handed to the postprocess stage
         if temp_dir and os.path.exists(temp_dir):
             try:
                 shutil.rmtree(temp_dir)
-                print(f"Cleaned up temporary directory on error: {temp_dir}")
+                logger.debug("Cleaned up temporary directory", extra={'path': temp_dir})
             except Exception as cleanup_e:
-                print(f"Error during error cleanup of {temp_dir}: {cleanup_e}")
-        
-        flash(f"Download failed: {str(e)}", 'error')
-        return redirect(url_for('dashboard')) # Redirect back with error
+                logger.warning("Could not clean up temporary directory", extra={'path': temp_dir, 'error': str(cleanup_e)})
+        if flight_key:
+            settle_followers(flight_key, download_id)
+
+# --- Postprocess stage ---
+# Fetch workers (DOWNLOAD_WORKERS threads, bound by bandwidth) only download; converting the fetched
+# files runs in POSTPROCESS_WORKERS ffmpeg processes at a time (default: one per CPU core). A burst
+# of MP3 encodes then queues here instead of holding fetch slots, and slow fetches never idle the CPUs.
+postprocess_queue = queue.Queue()
+
+def enqueue_postprocess(job):
+    start_download_workers()
+    postprocess_queue.put(job)
+
+def _postprocess_worker():
+    while True:
+        job = postprocess_queue.get()
+        metrics.inc('download_workers_active', pool='postprocess')
+        try:
+            with app.app_context(), log_context(download_id=job['download_id']):
+                run_postprocess(job)
+        except Exception:
+            logger.exception("Postprocess worker failed", extra={'download_id': job['download_id']})
+        finally:
+            metrics.inc('download_workers_active', -1, pool='postprocess')
+            postprocess_queue.task_done()
+
+# Characters of a title that are safe in stored file names and in Content-Disposition
+def safe_filename(title, max_length=100):
+    return "".join(c for c in title if c.isalnum() or c in (' ', '.', '_', '-')).strip()[:max_length]
+
+# Moves a finished file into UPLOAD_FOLDER, indexes it in the media cache so later requests for the same
+# video and preset reuse it, and attaches it to the job. If another worker stored the same media first,
+# theirs is kept and this copy is dropped. Returns the job's Download row (reloaded in that case).
+def store_media_file(download_record, job, source_path, unique_id, cpu_seconds=None):
+    # A unique prefix keeps stored files of the same title apart
+    permanent_filename = f"{unique_id}_{safe_filename(job['title'])}.{job['extension']}"
+    final_download_path = os.path.join(app.config['UPLOAD_FOLDER'], permanent_filename)
+    moving_at = time.monotonic()
+    shutil.move(source_path, final_download_path)
+    metrics.observe('download_stage_seconds', time.monotonic() - moving_at, stage='move')
+    logger.debug("Moved file", extra={'source': source_path, 'destination': final_download_path})
+    media = MediaFile(
+        cache_key=media_cache_key(job['video_key'], job['preset']),
+        filename=permanent_filename, # Store the name of the file in UPLOAD_FOLDER
+        title=job['title'][:200],
+        size_bytes=os.path.getsize(final_download_path),
+        plan=job['plan'],
+        source_codecs=job['source_codecs'],
+        postprocess_cpu_seconds=cpu_seconds,
+    )
+    db.session.add(media)
+    attach_media(download_record, media)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        os.remove(final_download_path)
+        download_record = db.session.get(Download, download_record.id)
+        attach_media(download_record, find_cached_media(job['video_key'], job['preset']))
+        db.session.commit()
+    return download_record
+
+# Progress label per plan, named like the yt-dlp postprocessors that used to do the same work
+POSTPROCESSOR_NAMES = {'remux': 'Remuxer', 'merge': 'Merger', 'encode': 'ExtractAudio'}
+
+# Convert the fetched files (if needed), store the result in UPLOAD_FOLDER and index it in the media cache
+def run_postprocess(job):
+    download_id = job['download_id']
+    download_record = db.session.get(Download, download_id)
+    preset = job['preset']
+    temp_dir = job['temp_dir']
+    try:
+        started_at = time.monotonic()
+        actual_filepath_in_temp = job['inputs'][0]
+        cpu_seconds = 0.0
+        if job['command']:
+            publish_progress(download_id, job['user_id'], job['flight_key'], {
+                'status': 'downloading',
+                'stage': 'postprocess',
+                'postprocessor': POSTPROCESSOR_NAMES[job['plan']],
+            })
+            actual_filepath_in_temp = os.path.join(temp_dir, f"{job['unique_id']}.{job['extension']}")
+            returncode, stderr, cpu_seconds = run_ffmpeg(job['command'] + [actual_filepath_in_temp])
+            if returncode != 0:
+                raise Exception(f"ffmpeg exited with {returncode}: {stderr.decode(errors='replace').strip()[-300:]}")
+            metrics.observe('download_stage_seconds', started_at - job['queued_at'], stage='postprocess_wait')
+            metrics.observe('download_stage_seconds', time.monotonic() - started_at, stage='ffmpeg')
+        logger.info("Postprocessed", extra={
+            'plan': job['plan'],
+            'source_codecs': job['source_codecs'],
+            'preset': preset,
+            'queued_seconds': round(started_at - job['queued_at'], 3),
+            'run_seconds': round(time.monotonic() - started_at, 3),
+            'ffmpeg_cpu_seconds': round(cpu_seconds, 3) if cpu_seconds is not None else None,
+        })
+
+        if not os.path.exists(actual_filepath_in_temp):
+            raise Exception("Downloaded file not found or path is incorrect in temporary directory.")
+        download_record = store_media_file(download_record, job, actual_filepath_in_temp, job['unique_id'], cpu_seconds)
+        metrics.inc('postprocess_jobs_total', plan=job['plan'])
+        metrics.inc('postprocess_cpu_seconds_total', cpu_seconds or 0.0, plan=job['plan'])
+        metrics.observe('download_stage_seconds', time.monotonic() - job['started_at'], stage='total')
+        download_finished(download_record)
+
+    except Exception as e:
+        logger.error("Download failed", extra={'error': str(e)})
+        db.session.rollback()
+        download_record.status = 'failed'
+        download_record.error = str(e)[:500]
+        db.session.commit()
+        download_finished(download_record)
+    finally:
+        if temp_dir and os.path.exists(temp_dir):
+            try:
+                shutil.rmtree(temp_dir)
+                logger.debug("Cleaned up temporary directory", extra={'path': temp_dir})
+            except Exception as cleanup_e:
+                logger.warning("Could not clean up temporary directory", extra={'path': temp_dir, 'error': str(cleanup_e)})
+        if job['flight_key']:
+            settle_followers(job['flight_key'], download_id)
+
+# Hand the leader's outcome to every Download that attached to its flight
+def settle_followers(flight_key, leader_id):
+    followers = in_flight.finish(flight_key)
+    if not followers:
+        return
+    try:
+        leader = db.session.get(Download, leader_id)
+        media = MediaFile.query.filter_by(filename=leader.filename).first() if leader.status == 'completed' else None
+        settled = []
+        for follower_id, _ in followers:
+            follower = db.session.get(Download, follower_id)
+            if not follower:
+                continue
+            if media:
+                attach_media(follower, media)
+            else:
+                follower.status = 'failed'
+                follower.error = leader.error
+            settled.append(follower)
+        db.session.commit()
+        for follower in settled:
+            download_finished(follower)
+        logger.info("Settled coalesced downloads", extra={'flight_key': flight_key, 'followers': len(followers)})
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Could not settle coalesced downloads", extra={'flight_key': flight_key, 'error': str(e)})
+
+# --- Playlist batches ---
+# A playlist is listed once with a flat extraction (no per-video page or format lookups), its entries
+# become 'waiting' Download rows, and at most PLAYLIST_CONCURRENCY of them are handed to the worker
+# queue at a time so one large playlist cannot occupy every worker.
+_batch_lock = threading.Lock()
+
+def start_batch(batch_id):
+    def run():
+        with app.app_context(), log_context(batch_id=batch_id):
+            expand_batch(batch_id)
+    threading.Thread(target=run, name=f"batch-expand-{batch_id}", daemon=True).start()
+
+# Flat results for channel pages are a list of tabs (Videos, Shorts, Live), which are listed one level further
+def flat_playlist_entries(ydl, info, depth=0):
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        url = info.get('webpage_url') or info.get('original_url') or info.get('url')
+        if url:
+            yield {'url': url, 'title': info.get('title'), 'duration': info.get('duration')}
+        return
+    for entry in info.get('entries') or []:
+        if not entry:
+            continue # Private or deleted videos
+        nested = entry.get('_type') == 'playlist' or (entry.get('_type') == 'url' and entry.get('ie_key') == 'YoutubeTab')
+        if nested:
+            if depth == 0:
+                if entry.get('_type') != 'playlist':
+                    entry = ydl.extract_info(entry['url'], download=False)
+                yield from flat_playlist_entries(ydl, entry, depth + 1)
+            continue
+        # Flat entries carry the video URL in 'url'; for fully resolved entries webpage_url can be the
+        # page that embeds them (the playlist itself), so it is only a fallback
+        url = entry.get('url') or entry.get('webpage_url')
+        if url:
+            yield {'url': url, 'title': entry.get('title'), 'duration': entry.get('duration')}
+
+# Runs in a download process; returns the playlist title and up to max_entries {'url', 'title', 'duration'} entries
+def list_playlist(url, max_entries):
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'playlistend': max_entries,
+        'quiet': True,
+        'no_warnings': True,
+        'logger': YtDlpLogger(),
+    }
+    with RateLimitedYoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        entries = []
+        for entry in flat_playlist_entries(ydl, info):
+            entries.append(entry)
+            if len(entries) >= max_entries:
+                break
+    return info.get('title'), entries
+
+def expand_batch(batch_id):
+    batch = db.session.get(DownloadBatch, batch_id)
+    if not batch or batch.status != 'expanding':
+        return
+    try:
+        title, entries = run_in_download_process(list_playlist, batch.url, app.config['PLAYLIST_MAX_ENTRIES'])
+        if not entries:
+            raise Exception("No downloadable entries found.")
+        batch.title = (title or batch.url)[:200]
+        for entry in entries:
+            db.session.add(Download(
+                user_id=batch.user_id,
+                batch_id=batch.id,
+                title=(entry['title'] or entry['url'])[:200],
+                url=entry['url'][:500],
+                download_type=batch.download_type,
+                preset=batch.preset,
+                status='waiting',
+                duration=int(entry['duration']) if entry['duration'] else None,
+            ))
+        batch.total_entries = len(entries)
+        batch.status = 'running'
+        db.session.commit()
+        logger.info("Expanded batch", extra={'entries': len(entries), 'url': batch.url})
+    except Exception as e:
+        logger.error("Could not expand batch", extra={'url': batch.url, 'error': str(e)})
+        db.session.rollback()
+        batch.status = 'failed'
+        batch.error = str(e)[:500]
+        db.session.commit()
+        publish_batch(batch)
+        return
+    advance_batch(batch_id)
+
+def batch_counts(batch_id):
+    return dict(db.session.query(Download.status, func.count(Download.id))
+                .filter(Download.batch_id == batch_id).group_by(Download.status).all())
+
+def batch_summary(batch, counts=None):
+    counts = batch_counts(batch.id) if counts is None else counts
+    return {
+        'id': batch.id,
+        'title': batch.title,
+        'url': batch.url,
+        'type': batch.download_type,
+        'status': batch.status,
+        'total': batch.total_entries,
+        'completed': counts.get('completed', 0) + counts.get('evicted', 0),
+        'failed': counts.get('failed', 0),
+        'active': counts.get('pending', 0) + counts.get('downloading', 0),
+        'waiting': counts.get('waiting', 0),
+        'error': batch.error,
+        'created_at': batch.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+def publish_batch(batch, counts=None):
+    progress_broker.publish(batch.user_id, f"batch-{batch.id}", dict(batch_summary(batch, counts), stage='batch'))
+
+# Tops the batch up to PLAYLIST_CONCURRENCY queued/running entries, or records its outcome once nothing is left.
+# The batch row is written before anything is counted: its row lock (the write lock on SQLite) serializes
+# this between processes, so no two of them release entries for the same free slots.
+def advance_batch(batch_id):
+    with _batch_lock:
+        locked = DownloadBatch.query.filter(DownloadBatch.id == batch_id, DownloadBatch.status != 'expanding').update(
+            {'status': DownloadBatch.status, 'updated_at': DownloadBatch.updated_at}, synchronize_session=False)
+        if not locked:
+            db.session.rollback()
+            return
+        batch = db.session.get(DownloadBatch, batch_id, populate_existing=True)
+        counts = batch_counts(batch_id)
+        active = counts.get('pending', 0) + counts.get('downloading', 0)
+        released = []
+        free_slots = app.config['PLAYLIST_CONCURRENCY'] - active
+        if free_slots > 0 and counts.get('waiting'):
+            released = (Download.query.filter_by(batch_id=batch_id, status='waiting')
+                        .order_by(Download.id).limit(free_slots).all())
+            for entry in released:
+                entry.status = 'pending'
+            counts['waiting'] -= len(released)
+            counts['pending'] = counts.get('pending', 0) + len(released)
+        if active or released or counts.get('waiting'):
+            batch.status = 'running'
+        else:
+            completed = counts.get('completed', 0) + counts.get('evicted', 0)
+            if completed == sum(counts.values()):
+                batch.status = 'completed'
+            else:
+                batch.status = 'partial' if completed else 'failed'
+        db.session.commit()
+    for entry in released:
+        publish_status(entry)
+    if released:
+        wake_download_workers()
+    publish_batch(batch, counts)
+
+# Overall progress of a playlist batch plus the state (and failure reason) of every entry
+@app.route('/batch/<int:batch_id>')
+@login_required
+def batch_status(batch_id):
+    batch = DownloadBatch.query.filter_by(id=batch_id, user_id=current_user.id).first()
+    if not batch:
+        return jsonify({'success': False, 'message': 'Batch not found'}), 404
+    entries = Download.query.filter_by(batch_id=batch.id).order_by(Download.id).all()
+    return jsonify(dict(batch_summary(batch), entries=[serialize_download(d) for d in entries]))
+
+# --- Stream-while-downloading mode ---
+# ffmpeg reads the selected format URLs itself and writes the result to stdout; every chunk is sent
+# to the client and appended to the file that becomes the permanent copy in UPLOAD_FOLDER.
+STREAMABLE_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Returns the ffmpeg command and the plan_output() plan, or (None, None) if ffmpeg cannot read the formats
+def build_stream_command(info, preset):
+    formats = info.get('requested_formats') or [info]
+    if any(not f.get('url') or f.get('protocol') not in STREAMABLE_PROTOCOLS for f in formats):
+        return None, None
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-xerror']
+    for f in formats:
+        headers = ''.join(f"{name}: {value}\r\n" for name, value in (f.get('http_headers') or {}).items())
+        if headers:
+            command += ['-headers', headers]
+        command += ['-i', f['url']]
+    # Even a 'store' plan goes through ffmpeg here, as a plain stream copy
+    plan, codec_args = plan_output(preset, formats)
+    command += codec_args or ['-c', 'copy']
+    return command + FORMAT_PRESETS[preset]['stream_args'] + ['pipe:1'], plan
+
+# Runs in a download process: extract and select formats, and describe how ffmpeg would stream them
+def prepare_stream(url, cached_info, preset, verbose):
+    ydl_opts, _ = build_ydl_opts(preset, '-', verbose)
+    with RateLimitedYoutubeDL(ydl_opts) as ydl:
+        info, extracted_info = extract_video_info(ydl, url, cached_info)
+        # Cached info dicts carry the format chosen for another download type, so select again
+        info = ydl.process_ie_result(info, download=False)
+    command, plan = build_stream_command(info, preset)
+    return {
+        'command': command,
+        'plan': plan,
+        'title': info.get('title', 'Unknown Title'),
+        'video_key': info_cache_key(info, url),
+        'source_codecs': source_codecs(info.get('requested_formats') or [info]),
+        'expected_bytes': info.get('filesize') or info.get('filesize_approx') or 0,
+        'extracted_info': extracted_info,
+    }
+
+# Returns a streaming response, or None when the selected formats cannot be piped through ffmpeg or no
+# download process is free
+def stream_download(url, preset, debug=False):
+    try:
+        stream = run_with_cached_info(prepare_stream, url, preset, debug, wait=app.config['DOWNLOAD_PROCESS_WAIT_SECONDS'])
+    except queue.Empty:
+        # Every download process is busy; a request thread must not wait for one indefinitely
+        logger.info("No free download process for streaming, queueing the job", extra={'url': url})
+        return None
+    if stream['command'] is None:
+        return None
+    storage_manager.enforce(incoming_bytes=stream['expected_bytes'])
+
+    title = stream['title']
+    download_extension = FORMAT_PRESETS[preset]['extension']
+    download_record = Download(
+        user_id=current_user.id,
+        title=title[:200],
+        url=url,
+        download_type=FORMAT_PRESETS[preset]['type'],
+        preset=preset,
+        status='downloading',
+        debug=debug,
+        # A stream cannot be resumed; if this process dies, recovery queues it as a normal job
+        lease_owner=worker_id(),
+        lease_expires_at=lease_deadline(),
+        attempts=1,
+    )
+    db.session.add(download_record)
+    db.session.commit()
+    publish_status(download_record)
+
+    temp_dir = job_work_dir(download_record.id)
+    os.makedirs(temp_dir, exist_ok=True)
+    part_path = os.path.join(temp_dir, f"stream.{download_extension}")
+    # ffmpeg's errors go to a file: nothing reads a pipe while the response streams, and a full one would stall it
+    stderr_path = os.path.join(temp_dir, 'ffmpeg.log')
+    with open(stderr_path, 'wb') as stderr:
+        process = subprocess.Popen(stream['command'], stdout=subprocess.PIPE, stderr=stderr)
+    job = {
+        'download_id': download_record.id,
+        'video_key': stream['video_key'],
+        'preset': preset,
+        'plan': stream['plan'],
+        'source_codecs': stream['source_codecs'],
+        'title': title,
+        'extension': download_extension,
+        'temp_dir': temp_dir,
+        'part_path': part_path,
+        'stderr_path': stderr_path,
+        'started_at': time.monotonic(),
+    }
+    logger.info("Streaming download", extra={'download_id': download_record.id, 'plan': stream['plan']})
+
+    started = []
+    def generate():
+        started.append(True)
+        out = open(part_path, 'wb')
+        try:
+            while True:
+                chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                yield chunk
+        except GeneratorExit:
+            # The client went away; finish writing the permanent copy without holding this worker
+            threading.Thread(target=_drain_stream, args=(process, out, job), daemon=True).start()
+            raise
+        except Exception:
+            process.kill()
+            out.close()
+            _finish_stream(process, job)
+            raise
+        out.close()
+        _finish_stream(process, job)
+
+    # A client that disconnects before the first chunk never runs generate(); store the file anyway
+    def on_close():
+        if not started:
+            threading.Thread(target=_drain_stream, args=(process, open(part_path, 'wb'), job), daemon=True).start()
+
+    response = Response(generate(), mimetype=mimetypes.guess_type(part_path)[0] or 'application/octet-stream')
+    response.call_on_close(on_close)
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(client_download_name(download_record))}"
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def _drain_stream(process, out, job):
+    try:
+        for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b''):
+            out.write(chunk)
+    finally:
+        out.close()
+        _finish_stream(process, job)
+
+# Last characters of a log file, as much as fits in download.error next to the exit status
+def read_log_tail(path, size=300):
+    try:
+        with open(path, 'rb') as log:
+            log.seek(max(0, os.path.getsize(path) - 4096))
+            return log.read().decode(errors='replace').strip()[-size:]
+    except OSError:
+        return ''
+
+# Runs once ffmpeg's output is fully written: store the file like a queued job would, or mark the job failed
+def _finish_stream(process, job):
+    returncode = process.wait()
+    with app.app_context():
+        download_record = db.session.get(Download, job['download_id'])
+        try:
+            if returncode != 0:
+                raise Exception(f"ffmpeg exited with {returncode}: {read_log_tail(job['stderr_path'])}")
+            metrics.observe('download_stage_seconds', time.monotonic() - job['started_at'], stage='stream')
+            metrics.inc('download_fetched_bytes_total', os.path.getsize(job['part_path']))
+            metrics.inc('postprocess_jobs_total', plan=job['plan'])
+            download_record = store_media_file(download_record, job, job['part_path'], str(uuid.uuid4()))
+            logger.info("Stored streamed download", extra={'download_id': job['download_id'], 'file': download_record.filename})
+        except Exception as e:
+            logger.error("Streamed download failed", extra={'download_id': job['download_id'], 'error': str(e)})
+            db.session.rollback()
+            download_record.status = 'failed'
+            download_record.error = str(e)[:500]
+            db.session.commit()
+        finally:
+            shutil.rmtree(job['temp_dir'], ignore_errors=True)
+        download_finished(download_record)
 
 # The /download_file/<filename> route now serves files from the permanent UPLOAD_FOLDER
 @app.route('/download_file/<filename>')
@@ -263,39 +2831,368 @@ def download_file(filename):
     # Verify user owns this download
     download = Download.query.filter_by(filename=filename, user_id=current_user.id).first()
     if not download or download.status != 'completed':
-        flash("File not found or not ready.", 'error')
+        flash("File not found or not ready. Files removed to free space can be fetched again from your downloads list.", 'error')
         return redirect(url_for('dashboard'))
     
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     if os.path.exists(file_path):
-        # Use the title from the database for the download name, append correct extension
-        download_name = download.title + ('.mp3' if download.download_type == 'audio' else '.mp4')
-        # Sanitize download_name for browser and limit length
-        safe_download_name = "".join([c for c in download_name if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
-        if len(safe_download_name) > 100:
-            safe_download_name = safe_download_name[:100] + ('.mp3' if download.download_type == 'audio' else '.mp4') # Re-add extension if truncated
-        
-        return send_file(file_path, as_attachment=True, download_name=safe_download_name)
+        storage_manager.touch(filename)
+        return serve_media_file(file_path, filename, client_download_name(download))
     flash("File not found on server.", 'error')
     return redirect(url_for('dashboard'))
 
+def client_download_name(download):
+    extension = os.path.splitext(download.filename or '')[1] or ('.' + FORMAT_PRESETS[download_preset(download)]['extension'])
+    # Use the title from the database for the download name, append correct extension
+    download_name = download.title + extension
+    # Sanitize download_name for browser and limit length
+    safe_download_name = safe_filename(download_name, max_length=None)
+    if len(safe_download_name) > 100:
+        safe_download_name = safe_download_name[:100] + extension # Re-add extension if truncated
+    return safe_download_name
+
+# Send a stored file according to FILE_SERVING_MODE. Stored files never change after they are
+# written, so the ETag derived from path, size and mtime is strong and lets clients resume with If-Range.
+def serve_media_file(file_path, filename, download_name):
+    if app.config['FILE_SERVING_MODE'] == 'x-accel':
+        response = Response(status=200)
+        response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_PREFIX'] + quote(filename)
+        response.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+        return response
+    # 'direct' and 'x-sendfile' (send_file() adds the X-Sendfile header itself when USE_X_SENDFILE is on)
+    return send_file(file_path, as_attachment=True, download_name=download_name, conditional=True, etag=True)
+
+
+# --- ZIP export ---
+# The archive is built while it is being sent. Entries are STORED (the media is already compressed) and
+# written to a sink that cannot seek and is emptied after every chunk, so memory stays at about one chunk
+# and no archive is staged on disk; zipfile then puts sizes and CRCs in a data descriptor after each entry.
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+class ZipStreamSink:
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+# entries: (path in UPLOAD_FOLDER, name inside the archive)
+def stream_zip(entries):
+    sink = ZipStreamSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for file_path, archive_name in entries:
+            try:
+                source = open(file_path, 'rb')
+            except OSError:
+                continue # Evicted or deleted after the export started
+            with source:
+                stat = os.fstat(source.fileno())
+                info = zipfile.ZipInfo(archive_name, date_time=time.localtime(stat.st_mtime)[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                info.file_size = stat.st_size
+                # Without seeking back, an entry of 4 GiB or more must announce ZIP64 sizes up front;
+                # offsets past 4 GiB and more than 65535 entries are handled by allowZip64 at the end
+                with archive.open(info, mode='w', force_zip64=stat.st_size >= zipfile.ZIP64_LIMIT) as target:
+                    while True:
+                        chunk = source.read(EXPORT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain() # Central directory
+
+# All completed downloads of the current user, or only those of one playlist batch (?batch=<id>), as one ZIP
+@app.route('/export')
+@login_required
+def export_downloads():
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    query = Download.query.filter_by(user_id=current_user.id, status='completed')
+    archive_title = 'YouTube downloads'
+    batch_id = request.args.get('batch', type=int)
+    if batch_id is not None:
+        batch = DownloadBatch.query.filter_by(id=batch_id, user_id=current_user.id).first()
+        if not batch:
+            if wants_json:
+                return jsonify({'success': False, 'message': 'Batch not found'}), 404
+            flash("Playlist not found.", 'error')
+            return redirect(url_for('dashboard'))
+        query = query.filter_by(batch_id=batch.id)
+        archive_title = batch.title
+
+    entries = []
+    filenames = set()
+    archive_names = set()
+    for download in query.order_by(Download.created_at, Download.id):
+        # Several history entries can share one stored file
+        if not download.filename or download.filename in filenames:
+            continue
+        filenames.add(download.filename)
+        archive_name = client_download_name(download)
+        base, extension = os.path.splitext(archive_name)
+        copy = 2
+        while archive_name in archive_names:
+            archive_name = f"{base} ({copy}){extension}"
+            copy += 1
+        archive_names.add(archive_name)
+        entries.append((os.path.join(app.config['UPLOAD_FOLDER'], download.filename), archive_name))
+
+    if not entries:
+        if wants_json:
+            return jsonify({'success': False, 'message': 'No completed downloads to export'}), 404
+        flash("No completed downloads to export.", 'error')
+        return redirect(url_for('dashboard'))
+
+    storage_manager.touch(*filenames)
+    safe_title = safe_filename(archive_title) or 'downloads'
+    return Response(stream_zip(entries), mimetype='application/zip', headers={
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(safe_title)}.zip",
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/delete_download/<int:download_id>', methods=['POST'])
+@login_required
+def delete_download(download_id):
+    download = Download.query.filter_by(id=download_id, user_id=current_user.id).first()
+    if not download or download.status in ('pending', 'downloading'):
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'success': False, 'message': 'Download not found or still in progress'}), 404
+        flash("Download not found or still in progress.", 'error')
+        return redirect(url_for('dashboard'))
+
+    # Other users may share the same stored file, so only our reference to it is released
+    if download.filename:
+        release_media(download.filename)
+    db.session.delete(download)
+    db.session.commit()
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'success': True})
+    flash('Download removed from your history.', 'success')
+    return redirect(url_for('dashboard'))
+
+# Queue an evicted (or failed) download again under the same history entry
+@app.route('/refetch/<int:download_id>', methods=['POST'])
+@login_required
+def refetch(download_id):
+    download = Download.query.filter_by(id=download_id, user_id=current_user.id).first()
+    if not download or download.status not in ('evicted', 'failed'):
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'success': False, 'message': 'Download not found or not re-fetchable'}), 404
+        flash("Download not found or not re-fetchable.", 'error')
+        return redirect(url_for('dashboard'))
+    refusal = admission_refusal(current_user.id)
+    if refusal:
+        return refuse_submission(refusal, request.accept_mimetypes.best == 'application/json')
+    download.status = 'pending'
+    download.error = None
+    db.session.commit()
+    publish_status(download)
+    wake_download_workers()
+    if download.batch_id:
+        advance_batch(download.batch_id) # Reopens a finished batch
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'success': True, 'job_id': download.id, 'status': download.status,
+                        'queue_position': queue_position(download.id)}), 202
+    flash('Download queued again.', 'success')
+    return redirect(url_for('dashboard'))
+
+@app.route('/storage')
+@login_required
+def storage():
+    stats = storage_manager.stats()
+    stats['user_usage_bytes'] = storage_manager.user_usage(current_user.id)
+    stats['user_quota_bytes'] = app.config['USER_QUOTA_BYTES']
+    return jsonify(stats)
+
+# Gauges of state owned elsewhere (queues, caches, the database) are read at scrape time
+def collect_metrics():
+    metrics.set('download_queue_depth', db.session.query(func.count(Download.id)).filter_by(status='pending').scalar(), queue='download')
+    metrics.set('download_queue_depth', postprocess_queue.qsize(), queue='postprocess')
+    metrics.set('download_workers', max(1, app.config['DOWNLOAD_WORKERS']), pool='download')
+    metrics.set('download_workers', max(1, app.config['POSTPROCESS_WORKERS']), pool='postprocess')
+    metrics.set('jobs_active', db.session.query(func.count(Download.id)).filter(Download.status.in_(ACTIVE_STATUSES)).scalar())
+
+    jobs = {result: metrics.get('media_cache_lookups_total', result=result) for result in ('hit', 'coalesced', 'miss')}
+    total_jobs = sum(jobs.values())
+    metrics.set('media_cache_hit_ratio', (jobs['hit'] + jobs['coalesced']) / total_jobs if total_jobs else 0.0)
+
+    lookups = {result: metrics.get('metadata_cache_lookups_total', result=result) for result in ('hit', 'persistent_hit', 'miss')}
+    total_lookups = sum(lookups.values())
+    metrics.set('metadata_cache_hit_ratio', (lookups['hit'] + lookups['persistent_hit']) / total_lookups if total_lookups else 0.0)
+    metrics.set('metadata_cache_entries', len(metadata_cache))
+
+    usage = storage_manager.stats()
+    metrics.set('storage_usage_bytes', usage['usage_bytes'])
+    metrics.set('storage_budget_bytes', usage['budget_bytes'])
+    metrics.set('storage_files', usage['files'])
+    metrics.set('storage_evicted_bytes_total', usage['evicted_bytes'])
+    disk = shutil.disk_usage(app.config['UPLOAD_FOLDER'])
+    metrics.set('disk_free_bytes', disk.free)
+    metrics.set('disk_total_bytes', disk.total)
+
+    for host, bucket in upstream_limiter.stats().items():
+        metrics.set('upstream_rate', bucket['rate'], host=host)
+        metrics.set('upstream_throttled_total', bucket['throttled_count'] or 0, host=host)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    collect_metrics()
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
+def serialize_download(d):
+    return {
+        'id': d.id,
+        'title': d.title,
+        'url': d.url, # Include URL for debugging/reference
+        'type': d.download_type,
+        'preset': download_preset(d),
+        'status': d.status,
+        'filename': d.filename,
+        'created_at': d.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'batch_id': d.batch_id,
+        'error': d.error,
+    }
+
+# --- Download history pagination ---
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+# Opaque to clients: the (created_at, id) of the last row of a page
+def history_cursor(download):
+    return f"{download.created_at.isoformat()},{download.id}"
+
+def parse_history_cursor(value):
+    try:
+        created_at, download_id = value.rsplit(',', 1)
+        return datetime.fromisoformat(created_at), int(download_id)
+    except (AttributeError, ValueError):
+        return None
+
+# Keyset pagination on (created_at, id): every page is a range scan of ix_download_user_created
+# starting at the cursor, so it costs the same on page 1 and page 500 (OFFSET would not).
+# id breaks ties between rows created in the same instant.
+def history_page(user_id, before=None, limit=HISTORY_PAGE_SIZE):
+    query = Download.query.filter(Download.user_id == user_id)
+    if before:
+        created_at, download_id = before
+        query = query.filter(or_(Download.created_at < created_at,
+                                 and_(Download.created_at == created_at, Download.id < download_id)))
+    downloads = query.order_by(Download.created_at.desc(), Download.id.desc()).limit(limit + 1).all()
+    next_cursor = history_cursor(downloads[limit - 1]) if len(downloads) > limit else None
+    return downloads[:limit], next_cursor
+
+# Older history, one page at a time: /history?before=<next_cursor>&limit=<n>
+@app.route('/history')
+@login_required
+def history():
+    before = request.args.get('before')
+    cursor = parse_history_cursor(before) if before else None
+    if before and cursor is None:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    downloads, next_cursor = history_page(current_user.id, cursor, limit)
+    return jsonify({'downloads': [serialize_download(d) for d in downloads], 'next_cursor': next_cursor})
+
+# Timestamps are taken before commit, so a row can become visible with an updated_at slightly older
+# than a cursor already handed out. Incremental queries look back this far; clients merge rows by id.
+CHECK_STATUS_OVERLAP = timedelta(seconds=2)
+CHECK_STATUS_PAGE_SIZE = 100
+
+# ?since= is either a change cursor (an updated_at) or, after a full page, the (updated_at, id) of that
+# page's last row, from which the next page continues without looking back
+def parse_status_cursor(value):
+    if not value:
+        return None
+    try:
+        if ',' in value:
+            updated_at, download_id = value.rsplit(',', 1)
+            return datetime.fromisoformat(updated_at), int(download_id)
+        return datetime.fromisoformat(value), None
+    except ValueError:
+        return None
+
+# Without ?since= this returns the latest 10 downloads; with the cursor from a previous response it
+# returns only rows changed since then, oldest change first. When more rows changed than fit on one page
+# the response has more=true and a cursor for the rest, which the client fetches straight away.
+# Unchanged state is answered with 304 via the ETag.
 @app.route('/check_status')
 @login_required
 def check_status():
-    downloads = Download.query.filter_by(user_id=current_user.id).order_by(Download.created_at.desc()).limit(10).all()
-    download_list = []
-    for d in downloads:
-        download_list.append({
-            'id': d.id,
-            'title': d.title,
-            'url': d.url, # Include URL for debugging/reference
-            'type': d.download_type,
-            'status': d.status,
-            'filename': d.filename,
-            'created_at': d.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify({'downloads': download_list})
+    since = parse_status_cursor(request.args.get('since'))
+    latest_update, download_count = db.session.query(
+        func.max(Download.updated_at), func.count(Download.id)
+    ).filter(Download.user_id == current_user.id).one()
+    cursor = latest_update.isoformat() if latest_update else ''
+    etag = f"{current_user.id}-{download_count}-{cursor}"
+    # A client continuing a catch-up still holds the ETag of the current state
+    continuing = since is not None and since[1] is not None
+    if not continuing and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    query = Download.query.filter_by(user_id=current_user.id)
+    more = False
+    if since:
+        updated_at, download_id = since
+        if continuing:
+            query = query.filter(or_(Download.updated_at > updated_at,
+                                     and_(Download.updated_at == updated_at, Download.id > download_id)))
+        else:
+            query = query.filter(Download.updated_at > updated_at - CHECK_STATUS_OVERLAP)
+        downloads = query.order_by(Download.updated_at, Download.id).limit(CHECK_STATUS_PAGE_SIZE + 1).all()
+        if len(downloads) > CHECK_STATUS_PAGE_SIZE:
+            downloads = downloads[:CHECK_STATUS_PAGE_SIZE]
+            cursor = f"{downloads[-1].updated_at.isoformat()},{downloads[-1].id}"
+            more = True
+    else:
+        downloads = query.order_by(Download.created_at.desc()).limit(10).all()
+    download_list = [serialize_download(d) for d in downloads]
+    response = jsonify({'downloads': download_list, 'cursor': cursor, 'incremental': since is not None, 'more': more})
+    if not more:
+        response.set_etag(etag)
+    return response
+
+# Server-Sent Events stream of the current user's job progress. Each connection waits on the
+# in-memory broker (no database access per tick) and is closed after EVENTS_STREAM_SECONDS;
+# EventSource reconnects on its own and resumes from Last-Event-ID. Jobs run by other processes reach
+# the broker through ProgressRelay.
+@app.route('/events')
+@login_required
+def events():
+    user_id = current_user.id
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+    except ValueError:
+        last_seq = 0
+
+    progress_relay.start_reader()
+
+    def stream(last_seq):
+        deadline = time.monotonic() + app.config['EVENTS_STREAM_SECONDS']
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            events, last_seq = progress_broker.wait(user_id, last_seq, timeout=20)
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                yield f"id: {last_seq}\nevent: progress\ndata: {json.dumps(event)}\n\n"
+
+    return Response(stream(last_seq), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
 
 # Template files (leave as is, or run create_templates() once)
 @app.route('/create_templates')
@@ -576,9 +3473,11 @@ document.getElementById('authForm').addEventListener('submit', async function(e)
                 
                 <div>
                     <label class="block text-sm font-medium mb-2">Download Type</label>
-                    <select id="downloadType" name="type" class="w-full px-4 py-3 card border rounded-lg focus:outline-none focus:ring-2 focus:ring-blue-500">
-                        <option value="video">Video (MP4)</option>
-                        <option value="audio">Audio (MP3)</option>
+                    <select id="downloadType" name="preset" class="w-full px-4 py-3 card border rounded-lg focus:outline-none focus:ring-2 focus:ring-blue-500">
+                        <option value="mp4">Video (MP4)</option>
+                        <option value="mp3">Audio (MP3)</option>
+                        <option value="m4a" title="Keeps the original AAC audio when the source has it, without re-encoding">Audio (original, M4A)</option>
+                        <option value="opus" title="Keeps the original Opus audio when the source has it, without re-encoding">Audio (original, Opus)</option>
                     </select>
                 </div>
                 
@@ -588,22 +3487,69 @@ document.getElementById('authForm').addEventListener('submit', async function(e)
                     Download
                 </button>
             </div>
+            <label class="inline-flex items-center mt-4 text-sm opacity-75">
+                <input type="checkbox" id="streamMode" name="mode" value="stream" class="mr-2">
+                Stream to my browser while the server is still downloading
+            </label>
+            <label class="inline-flex items-center mt-4 ml-6 text-sm opacity-75">
+                <input type="checkbox" id="playlistMode" name="playlist" value="1" class="mr-2">
+                Download every video of a playlist or channel
+            </label>
         </form>
     </div>
     
+    {% if batches %}
+    <div class="card border rounded-xl p-8 mb-8">
+        <h3 class="text-2xl font-bold mb-6">Playlists</h3>
+        {% for batch in batches %}
+        <div class="card border rounded-lg p-4 mb-4" id="batch-{{ batch.id }}">
+            <div class="flex justify-between items-center">
+                <div class="flex-1">
+                    <h4 class="font-semibold mb-1">{{ batch.title }}</h4>
+                    <div class="text-sm opacity-75">
+                        <span class="mr-4">
+                            <i class="fas fa-{{ 'video' if batch.type == 'video' else 'music' }} mr-1"></i>
+                            {{ batch.type.title() }}
+                        </span>
+                        <span class="mr-4">{{ batch.created_at }}</span>
+                        <span id="progress-batch-{{ batch.id }}">
+                            {{ batch.status.title() }}{% if batch.total %} · {{ batch.completed }} of {{ batch.total }} done{% endif %}{% if batch.failed %}, {{ batch.failed }} failed{% endif %}{% if batch.error %} · {{ batch.error }}{% endif %}
+                        </span>
+                    </div>
+                </div>
+                {% if batch.completed %}
+                <a href="{{ url_for('export_downloads', batch=batch.id) }}" title="Completed entries as one ZIP file"
+                   class="bg-green-600 text-white px-4 py-2 rounded-lg hover:bg-green-700 transition-colors">
+                    <i class="fas fa-file-archive mr-1"></i>
+                    ZIP
+                </a>
+                {% endif %}
+            </div>
+        </div>
+        {% endfor %}
+    </div>
+    {% endif %}
+
     <div class="card border rounded-xl p-8">
         <div class="flex justify-between items-center mb-6">
             <h3 class="text-2xl font-bold">Your Downloads</h3>
-            <button onclick="checkStatus()" class="card border px-4 py-2 rounded-lg hover:opacity-80 transition-opacity">
-                <i class="fas fa-refresh mr-2"></i>
-                Refresh
-            </button>
+            <div>
+                <a href="{{ url_for('export_downloads') }}" title="All completed downloads as one ZIP file"
+                   class="card border px-4 py-2 rounded-lg hover:opacity-80 transition-opacity mr-2">
+                    <i class="fas fa-file-archive mr-2"></i>
+                    Download all
+                </a>
+                <button onclick="checkStatus()" class="card border px-4 py-2 rounded-lg hover:opacity-80 transition-opacity">
+                    <i class="fas fa-refresh mr-2"></i>
+                    Refresh
+                </button>
+            </div>
         </div>
         
         <div id="downloadsList">
             {% if downloads %}
                 {% for download in downloads %}
-                <div class="card border rounded-lg p-4 mb-4">
+                <div class="card border rounded-lg p-4 mb-4" id="download-{{ download.id }}">
                     <div class="flex justify-between items-center">
                         <div class="flex-1">
                             <h4 class="font-semibold mb-1">{{ download.title }}</h4>
@@ -620,11 +3566,14 @@ document.getElementById('authForm').addEventListener('submit', async function(e)
                                         <i class="fas fa-spinner fa-spin text-blue-600 mr-1"></i>
                                     {% elif download.status == 'failed' %}
                                         <i class="fas fa-times-circle text-red-600 mr-1"></i>
+                                    {% elif download.status == 'evicted' %}
+                                        <i class="fas fa-archive text-gray-500 mr-1"></i>
                                     {% else %}
                                         <i class="fas fa-clock text-yellow-600 mr-1"></i>
                                     {% endif %}
                                     {{ download.status.title() }}
                                 </span>
+                                <span class="ml-4" id="progress-{{ download.id }}"></span>
                             </div>
                         </div>
                         {% if download.status == 'completed' and download.filename %}
@@ -634,6 +3583,23 @@ document.getElementById('authForm').addEventListener('submit', async function(e)
                             Download
                         </a>
                         {% endif %}
+                        {% if download.status in ('evicted', 'failed') %}
+                        <form action="{{ url_for('refetch', download_id=download.id) }}" method="POST">
+                            <button type="submit" title="The file is no longer on the server; download it again"
+                                    class="bg-blue-600 text-white px-4 py-2 rounded-lg hover:bg-blue-700 transition-colors">
+                                <i class="fas fa-redo mr-1"></i>
+                                Re-fetch
+                            </button>
+                        </form>
+                        {% endif %}
+                        {% if download.status in ('completed', 'failed', 'evicted') %}
+                        <form action="{{ url_for('delete_download', download_id=download.id) }}" method="POST" class="ml-2">
+                            <button type="submit" title="Remove from history"
+                                    class="card border px-3 py-2 rounded-lg hover:opacity-80 transition-opacity">
+                                <i class="fas fa-trash"></i>
+                            </button>
+                        </form>
+                        {% endif %}
                     </div>
                 </div>
                 {% endfor %}
@@ -644,6 +3610,14 @@ document.getElementById('authForm').addEventListener('submit', async function(e)
                 </div>
             {% endif %}
         </div>
+
+        <div id="historyMore" class="text-center mt-2"{% if not next_cursor %} style="display: none;"{% endif %}>
+            <button type="button" id="historyMoreBtn" onclick="loadMoreHistory()"
+                    class="card border px-4 py-2 rounded-lg hover:opacity-80 transition-opacity">
+                <i class="fas fa-chevron-down mr-2"></i>
+                Load older downloads
+            </button>
+        </div>
     </div>
 </div>
 
@@ -651,7 +3625,15 @@ document.getElementById('authForm').addEventListener('submit', async function(e)
 document.getElementById('downloadForm').addEventListener('submit', function() {
     const btn = document.getElementById('downloadBtn');
     btn.disabled = true;
-    btn.innerHTML = '<i class="fas fa-spinner fa-spin mr-2"></i>Preparing Download...';
+    btn.innerHTML = '<i class="fas fa-spinner fa-spin mr-2"></i>Queuing Download...';
+    // A streamed download arrives as an attachment, so the page is not reloaded afterwards
+    if (document.getElementById('streamMode').checked) {
+        setTimeout(function() {
+            btn.disabled = false;
+            btn.innerHTML = '<i class="fas fa-download mr-2"></i>Download';
+            scheduleRefresh();
+        }, 3000);
+    }
 });
 
 // Reset the button state on page load
@@ -671,50 +3653,129 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 
+// Rows known to the page and the change cursor / ETag of the last /check_status answer,
+// so each refresh only transfers what changed (or nothing at all, as a 304).
+// The page starts with the newest page of the history; older pages are loaded on demand.
+const knownDownloads = {};
+let statusCursor = {{ status_cursor|tojson }};
+let statusEtag = null;
+let historyCursor = {{ next_cursor|tojson }};
+let oldestLoadedId = null;
+let historyLoading = false;
+
+function addHistory(downloads) {
+    downloads.forEach(download => {
+        knownDownloads[download.id] = download;
+        if (oldestLoadedId === null || download.id < oldestLoadedId) oldestLoadedId = download.id;
+    });
+}
+addHistory({{ history|tojson }});
+
+async function loadMoreHistory() {
+    if (!historyCursor || historyLoading) return;
+    historyLoading = true;
+    const btn = document.getElementById('historyMoreBtn');
+    btn.disabled = true;
+    try {
+        const response = await fetch('/history?before=' + encodeURIComponent(historyCursor), {cache: 'no-store'});
+        const result = await response.json();
+        addHistory(result.downloads);
+        historyCursor = result.next_cursor;
+        renderDownloads();
+    } catch (error) {
+        console.error('Error loading history:', error);
+    } finally {
+        historyLoading = false;
+        btn.disabled = false;
+        document.getElementById('historyMore').style.display = historyCursor ? '' : 'none';
+    }
+}
+
+// Infinite scroll: fetch the next page once the button comes into view
+if (window.IntersectionObserver) {
+    new IntersectionObserver(function(entries) {
+        if (entries.some(entry => entry.isIntersecting)) loadMoreHistory();
+    }, {rootMargin: '200px'}).observe(document.getElementById('historyMore'));
+}
+
 async function checkStatus() {
     try {
-        const response = await fetch('/check_status');
+        const url = statusCursor ? '/check_status?since=' + encodeURIComponent(statusCursor) : '/check_status';
+        const response = await fetch(url, {
+            cache: 'no-store',
+            headers: statusEtag ? {'If-None-Match': statusEtag} : {}
+        });
+        if (response.status === 304) return;
         const result = await response.json();
-        
-        const downloadsList = document.getElementById('downloadsList');
-        
-        if (result.downloads.length === 0) {
-            downloadsList.innerHTML = `
-                <div class="text-center py-12 opacity-75">
-                    <i class="fas fa-inbox text-4xl mb-4"></i>
-                    <p>No downloads yet. Start by entering a YouTube URL above.</p>
-                </div>
-            `;
-        } else {
-            downloadsList.innerHTML = result.downloads.map(download => `
-                <div class="card border rounded-lg p-4 mb-4">
-                    <div class="flex justify-between items-center">
-                        <div class="flex-1">
-                            <h4 class="font-semibold mb-1">${download.title}</h4>
-                            <div class="text-sm opacity-75">
-                                <span class="mr-4">
-                                    <i class="fas fa-${download.type === 'video' ? 'video' : 'music'} mr-1"></i>
-                                    ${download.type.charAt(0).toUpperCase() + download.type.slice(1)}
-                                </span>
-                                <span class="mr-4">${download.created_at}</span>
-                                <span class="status-${download.status}">
-                                    ${getStatusIcon(download.status)}
-                                    ${download.status.charAt(0).toUpperCase() + download.status.slice(1)}
-                                </span>
-                            </div>
+        statusEtag = response.headers.get('ETag');
+        statusCursor = result.cursor || null;
+        result.downloads.forEach(download => {
+            // Changes to rows older than the loaded pages arrive with those pages instead
+            if (historyCursor && !(download.id in knownDownloads) && download.id < oldestLoadedId) return;
+            knownDownloads[download.id] = download;
+        });
+        renderDownloads();
+        if (result.more) return checkStatus(); // More rows changed than fit on one page
+    } catch (error) {
+        console.error('Error checking status:', error);
+    }
+}
+
+function renderDownloads() {
+    const downloads = Object.values(knownDownloads).sort((a, b) => b.id - a.id);
+    
+    const downloadsList = document.getElementById('downloadsList');
+    
+    if (downloads.length === 0) {
+        downloadsList.innerHTML = `
+            <div class="text-center py-12 opacity-75">
+                <i class="fas fa-inbox text-4xl mb-4"></i>
+                <p>No downloads yet. Start by entering a YouTube URL above.</p>
+            </div>
+        `;
+    } else {
+        downloadsList.innerHTML = downloads.map(download => `
+            <div class="card border rounded-lg p-4 mb-4" id="download-${download.id}">
+                <div class="flex justify-between items-center">
+                    <div class="flex-1">
+                        <h4 class="font-semibold mb-1">${download.title}</h4>
+                        <div class="text-sm opacity-75">
+                            <span class="mr-4">
+                                <i class="fas fa-${download.type === 'video' ? 'video' : 'music'} mr-1"></i>
+                                ${download.type.charAt(0).toUpperCase() + download.type.slice(1)}
+                            </span>
+                            <span class="mr-4">${download.created_at}</span>
+                            <span class="status-${download.status}">
+                                ${getStatusIcon(download.status)}
+                                ${download.status.charAt(0).toUpperCase() + download.status.slice(1)}
+                            </span>
+                            <span class="ml-4" id="progress-${download.id}">${formatProgress(latestProgress[download.id])}</span>
                         </div>
-                        ${download.status === 'completed' && download.filename ? 
-                            `<a href="/download_file/${download.filename}" 
-                               class="bg-green-600 text-white px-4 py-2 rounded-lg hover:bg-green-700 transition-colors">
-                                <i class="fas fa-download mr-1"></i>
-                                Download
-                            </a>` : ''}
                     </div>
+                    ${download.status === 'completed' && download.filename ? 
+                        `<a href="/download_file/${download.filename}" 
+                           class="bg-green-600 text-white px-4 py-2 rounded-lg hover:bg-green-700 transition-colors">
+                            <i class="fas fa-download mr-1"></i>
+                            Download
+                        </a>` : ''}
+                    ${download.status === 'evicted' || download.status === 'failed' ?
+                        `<form action="/refetch/${download.id}" method="POST">
+                            <button type="submit" title="The file is no longer on the server; download it again"
+                                    class="bg-blue-600 text-white px-4 py-2 rounded-lg hover:bg-blue-700 transition-colors">
+                                <i class="fas fa-redo mr-1"></i>
+                                Re-fetch
+                            </button>
+                        </form>` : ''}
+                    ${['completed', 'failed', 'evicted'].includes(download.status) ?
+                        `<form action="/delete_download/${download.id}" method="POST" class="ml-2">
+                            <button type="submit" title="Remove from history"
+                                    class="card border px-3 py-2 rounded-lg hover:opacity-80 transition-opacity">
+                                <i class="fas fa-trash"></i>
+                            </button>
+                        </form>` : ''}
                 </div>
-            `).join('');
-        }
-    } catch (error) {
-        console.error('Error checking status:', error);
+            </div>
+        `).join('');
     }
 }
 
@@ -726,13 +3787,93 @@ function getStatusIcon(status) {
             return '<i class="fas fa-spinner fa-spin text-blue-600 mr-1"></i>';
         case 'failed':
             return '<i class="fas fa-times-circle text-red-600 mr-1"></i>';
+        case 'evicted':
+            return '<i class="fas fa-archive text-gray-500 mr-1"></i>';
         default:
             return '<i class="fas fa-clock text-yellow-600 mr-1"></i>';
     }
 }
 
-// Auto-refresh downloads every 10 seconds
-setInterval(checkStatus, 10000);
+// Latest progress event per download, pushed by the server over /events
+const latestProgress = {};
+
+function formatBytes(bytes) {
+    if (!bytes) return '0 B';
+    const units = ['B', 'KiB', 'MiB', 'GiB'];
+    let i = 0;
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024;
+        i++;
+    }
+    return bytes.toFixed(i === 0 ? 0 : 1) + ' ' + units[i];
+}
+
+function formatProgress(event) {
+    if (!event || event.status !== 'downloading' || !event.stage) return '';
+    if (event.stage === 'throttled') {
+        return 'Waiting for ' + event.host + ' (' + Math.ceil(event.wait) + 's)...';
+    }
+    if (event.stage === 'postprocess') {
+        if (event.postprocessor === 'queued') return 'Waiting to convert...';
+        return 'Converting' + (event.postprocessor ? ' (' + event.postprocessor + ')' : '') + '...';
+    }
+    const parts = [];
+    if (event.total_bytes) {
+        parts.push(Math.floor(100 * event.downloaded_bytes / event.total_bytes) + '%');
+    } else {
+        parts.push(formatBytes(event.downloaded_bytes));
+    }
+    if (event.speed) parts.push(formatBytes(event.speed) + '/s');
+    if (event.eta != null) parts.push('ETA ' + event.eta + 's');
+    return parts.join(' · ');
+}
+
+// Same text as the server-rendered batch rows
+function formatBatch(event) {
+    let text = event.status.charAt(0).toUpperCase() + event.status.slice(1);
+    if (event.total) text += ' · ' + event.completed + ' of ' + event.total + ' done';
+    if (event.failed) text += ', ' + event.failed + ' failed';
+    if (event.error) text += ' · ' + event.error;
+    return text;
+}
+
+function handleProgress(event) {
+    latestProgress[event.id] = event;
+    const progress = document.getElementById('progress-' + event.id);
+    // Playlist batches (ids like "batch-3") only report aggregate counts; their entries arrive as their own events
+    if (event.stage === 'batch') {
+        if (progress) progress.textContent = formatBatch(event);
+        return;
+    }
+    // Status changes and unknown jobs need the full row; progress ticks only touch the text
+    if (!progress || !event.stage) {
+        scheduleRefresh();
+        return;
+    }
+    progress.textContent = formatProgress(event);
+}
+
+// Collapse a burst of status changes (e.g. the snapshot sent on connect) into one refresh
+let refreshTimer = null;
+function scheduleRefresh() {
+    if (refreshTimer) return;
+    refreshTimer = setTimeout(function() {
+        refreshTimer = null;
+        checkStatus();
+    }, 300);
+}
+
+if (window.EventSource) {
+    const source = new EventSource('/events');
+    source.addEventListener('progress', function(e) {
+        handleProgress(JSON.parse(e.data));
+    });
+    // Slow safety net for anything the stream missed (relaying turned off, a dropped connection)
+    setInterval(checkStatus, 60000);
+} else {
+    // Auto-refresh downloads every 10 seconds
+    setInterval(checkStatus, 10000);
+}
 </script>
 {% endblock %}'''
     
@@ -744,6 +3885,7 @@ setInterval(checkStatus, 10000);
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        ensure_schema()
     
     # Create templates on first run (or if they don't exist)
     # You might want to remove this line after the first successful run
@@ -755,4 +3897,5 @@ if __name__ == '__main__':
     # Add these lines if they are missing or commented out
     with app.app_context(): # Ensure the app context is pushed for operations like db.create_all()
         db.create_all() # This should create your database tables if they don't exist
+        ensure_schema() # Adds columns and indexes introduced after the tables were created
     app.run(debug=True) # debug=True is good for local development
\ No newline at end of file
@@ -0,0 +1,322 @@
+# End-to-end throughput and latency of the download pipeline, without network access.
+#
+# Generates synthetic media with ffmpeg, serves it from a local HTTP server as direct links (yt-dlp's
+# generic extractor path) and runs A.py on a throwaway database and download folder. Simulated users
+# register, queue jobs, poll /check_status like the dashboard does, then fetch their files.
+#
+#   python benchmarks/end_to_end.py --users 8 --jobs-per-user 4 --media-seconds 30
+#
+# Needs ffmpeg on PATH. The upstream rate limit is raised by default so the run measures the app rather
+# than UPSTREAM_RATE. Prints one JSON object so results can be diffed between releases.
+import argparse
+import http.cookiejar
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# preset -> synthetic source file it is requested from
+PRESET_SOURCES = {
+    'mp3': 'audio.m4a', # encode
+    'm4a': 'audio.m4a', # store
+    'opus': 'audio.webm', # store
+    'mp4': 'video.mp4', # store
+}
+
+MEDIA_TYPES = {'.m4a': 'audio/mp4', '.webm': 'audio/webm', '.mp4': 'video/mp4'}
+
+
+def generate_media(directory, seconds):
+    sine = ['-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={seconds}']
+    commands = {
+        'audio.m4a': sine + ['-c:a', 'aac', '-b:a', '128k'],
+        'audio.webm': sine + ['-c:a', 'libopus', '-b:a', '96k'],
+        'video.mp4': ['-f', 'lavfi', '-i', f'testsrc2=size=640x360:rate=25:duration={seconds}'] + sine
+                     + ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '128k',
+                        '-shortest', '-movflags', '+faststart'],
+    }
+    for name, args in commands.items():
+        path = os.path.join(directory, name)
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] + args + [path],
+                                stdin=subprocess.DEVNULL, capture_output=True)
+        if result.returncode != 0 and name == 'video.mp4':
+            # ffmpeg builds without libx264 still have the native MPEG-4 encoder
+            args = [a if a != 'libx264' else 'mpeg4' for a in args if a not in ('-preset', 'veryfast')]
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] + args + [path],
+                                    stdin=subprocess.DEVNULL, capture_output=True)
+        if result.returncode != 0:
+            raise SystemExit(f'ffmpeg could not generate {name}: {result.stderr.decode(errors="replace").strip()}')
+
+
+# Serves <directory>/<name> for any /media/<anything>/<name>, so every job can use its own URL
+# (and therefore miss the metadata and media caches) while sharing the same few files
+def serve_media(directory, port_queue):
+    class Handler(SimpleHTTPRequestHandler):
+        extensions_map = dict(SimpleHTTPRequestHandler.extensions_map, **MEDIA_TYPES)
+
+        def translate_path(self, path):
+            return os.path.join(directory, os.path.basename(path.split('?', 1)[0]))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples):
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.mean(samples) * 1000, 2),
+    }
+
+
+class SimulatedUser:
+    def __init__(self, base_url, name, recorder):
+        self.base_url = base_url
+        self.name = name
+        self.recorder = recorder
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    # Returns (status, body); a 429 is waited out for Retry-After seconds and sent again
+    def request(self, endpoint, path, data=None, accept='application/json'):
+        body = None
+        headers = {'Accept': accept}
+        if data is not None:
+            body = json.dumps(data).encode() if endpoint == 'POST /register' else urllib.parse.urlencode(data).encode()
+            headers['Content-Type'] = 'application/json' if endpoint == 'POST /register' else 'application/x-www-form-urlencoded'
+        while True:
+            started = time.perf_counter()
+            try:
+                with self.opener.open(urllib.request.Request(self.base_url + path, data=body, headers=headers)) as response:
+                    payload = response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                payload = e.read()
+                status = e.code
+                if status == 429:
+                    self.recorder.record(endpoint, time.perf_counter() - started, status)
+                    time.sleep(float(e.headers.get('Retry-After') or 1))
+                    continue
+            self.recorder.record(endpoint, time.perf_counter() - started, status)
+            return status, payload
+
+    def run(self, media_base, presets, jobs_per_user, poll_interval, deadline):
+        self.request('POST /register', '/register', {'username': self.name, 'email': f'{self.name}@bench.local', 'password': 'bench'})
+        self.request('GET /dashboard', '/dashboard', accept='text/html')
+        submitted = {}
+        for i in range(jobs_per_user):
+            preset = presets[i % len(presets)]
+            url = f'{media_base}/{self.name}-{i}/{PRESET_SOURCES[preset]}'
+            status, payload = self.request('POST /download', '/download', {'url': url, 'preset': preset})
+            if status == 202:
+                submitted[json.loads(payload)['job_id']] = time.perf_counter()
+        finished = {}
+        # Incremental polls like the dashboard's; starting from the epoch also returns jobs that finished
+        # before the first poll, beyond the 10 newest a plain /check_status lists
+        cursor = '1970-01-01T00:00:00'
+        more = False
+        while len(finished) < len(submitted) and time.perf_counter() < deadline:
+            if not more:
+                time.sleep(poll_interval)
+            more = False
+            status, payload = self.request('GET /check_status', '/check_status?since=' + urllib.parse.quote(cursor))
+            if status != 200:
+                continue
+            page = json.loads(payload)
+            cursor = page['cursor'] or cursor
+            more = page.get('more', False) # A full page; the rest follows at once
+            for download in page['downloads']:
+                job_id = download['id']
+                if job_id in submitted and job_id not in finished and download['status'] in ('completed', 'failed'):
+                    finished[job_id] = download
+                    self.recorder.job_done(download['status'], time.perf_counter() - submitted[job_id])
+        for download in finished.values():
+            if download['filename']:
+                self.request('GET /download_file', f"/download_file/{urllib.parse.quote(download['filename'])}", accept='*/*')
+        self.request('GET /history', '/history')
+        self.recorder.job_timeouts(len(submitted) - len(finished))
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {} # endpoint -> [seconds]
+        self.errors = {} # endpoint -> count of non-2xx responses
+        self.job_latencies = []
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.last_job_done = None
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if status >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def job_done(self, status, seconds):
+        with self._lock:
+            if status == 'completed':
+                self.completed += 1
+                self.job_latencies.append(seconds)
+            else:
+                self.failed += 1
+            self.last_job_done = time.perf_counter()
+
+    def job_timeouts(self, count):
+        with self._lock:
+            self.timed_out += count
+
+
+# Mean seconds per download stage from the app's own download_stage_seconds histogram
+def stage_means(metrics_text):
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        if line.startswith('download_stage_seconds_sum') or line.startswith('download_stage_seconds_count'):
+            name, value = line.rsplit(' ', 1)
+            stage = name.split('stage="', 1)[1].split('"', 1)[0]
+            (sums if '_sum' in name else counts)[stage] = float(value)
+    return {stage: round(sums[stage] / counts[stage], 4) for stage in sorted(counts) if counts[stage]}
+
+
+def counter_total(metrics_text, name):
+    return sum(float(line.rsplit(' ', 1)[1]) for line in metrics_text.splitlines()
+               if line.startswith(name + '{') or line.startswith(name + ' '))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the download pipeline')
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--jobs-per-user', type=int, default=4)
+    parser.add_argument('--presets', default='mp3,m4a,opus,mp4', help='comma-separated presets, used round-robin')
+    parser.add_argument('--media-seconds', type=int, default=30, help='duration of the synthetic media')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--postprocess-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--upstream-rate', type=float, default=1000, help='UPSTREAM_RATE for the local media host')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=600, help='give up on jobs not finished after this many seconds')
+    parser.add_argument('--verbose', action='store_true', help='show the app and yt-dlp output on stderr')
+    args = parser.parse_args()
+    presets = [p.strip() for p in args.presets.split(',') if p.strip()]
+    unknown = [p for p in presets if p not in PRESET_SOURCES]
+    if unknown:
+        parser.error(f'unknown presets: {", ".join(unknown)}')
+
+    workdir = tempfile.mkdtemp(prefix='e2e-bench-')
+    media_dir = os.path.join(workdir, 'media')
+    os.makedirs(media_dir)
+    generate_media(media_dir, args.media_seconds)
+
+    port_queue = multiprocessing.Queue()
+    media_server = multiprocessing.Process(target=serve_media, args=(media_dir, port_queue), daemon=True)
+    media_server.start()
+    media_base = f'http://127.0.0.1:{port_queue.get(timeout=10)}/media'
+
+    # A.py reads its configuration at import time
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'UPLOAD_FOLDER': os.path.join(workdir, 'downloads'),
+        'DOWNLOAD_WORKERS': str(args.download_workers),
+        'POSTPROCESS_WORKERS': str(args.postprocess_workers),
+        'UPSTREAM_RATE': str(args.upstream_rate),
+        'UPSTREAM_RATE_MAX': str(max(args.upstream_rate, 50)),
+        'UPSTREAM_BURST': str(max(args.upstream_rate, 20)),
+        # Download processes log to the inherited stdout, which carries the result
+        'LOG_LEVEL': 'INFO' if args.verbose else 'ERROR',
+    })
+    results_out = sys.stdout
+    sys.stdout = sys.stderr if args.verbose else open(os.devnull, 'w')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sys.path.insert(0, REPO_ROOT)
+    import A
+    from werkzeug.serving import make_server
+    with A.app.app_context():
+        A.db.create_all()
+        A.ensure_schema()
+    app_server = make_server('127.0.0.1', 0, A.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{app_server.server_port}'
+
+    recorder = Recorder()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    deadline = started + args.timeout
+    users = [SimulatedUser(base_url, f'bench{i}', recorder) for i in range(args.users)]
+    threads = [threading.Thread(target=user.run, args=(media_base, presets, args.jobs_per_user, args.poll_interval, deadline))
+               for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = (recorder.last_job_done or time.perf_counter()) - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    # Download processes and ffmpeg report their own CPU time; download processes are not always our children
+    with urllib.request.urlopen(base_url + '/metrics') as response:
+        metrics_text = response.read().decode()
+    stages = stage_means(metrics_text)
+    download_process_cpu = counter_total(metrics_text, 'download_process_cpu_seconds_total')
+    download_process_rss = counter_total(metrics_text, 'download_process_peak_rss_bytes')
+    ffmpeg_cpu = counter_total(metrics_text, 'postprocess_cpu_seconds_total')
+    app_server.shutdown()
+    media_server.terminate()
+    media_server.join()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    jobs = recorder.completed + recorder.failed
+    app_cpu = (self_after.ru_utime + self_after.ru_stime) - (self_before.ru_utime + self_before.ru_stime)
+    result = {
+        'users': args.users,
+        'jobs': args.users * args.jobs_per_user,
+        'presets': presets,
+        'media_seconds': args.media_seconds,
+        'download_workers': args.download_workers,
+        'postprocess_workers': args.postprocess_workers,
+        'completed': recorder.completed,
+        'failed': recorder.failed,
+        'timed_out': recorder.timed_out,
+        'wall_seconds': round(wall, 3),
+        'jobs_per_sec': round(recorder.completed / wall, 3) if wall > 0 else None,
+        'job_latency': summarize(recorder.job_latencies),
+        'endpoints': {endpoint: dict(summarize(samples), errors=recorder.errors.get(endpoint, 0))
+                      for endpoint, samples in sorted(recorder.latencies.items())},
+        # The app process also runs the simulated users; yt-dlp (download processes) and ffmpeg run in child processes
+        'cpu_seconds_per_job': round(app_cpu / jobs, 4) if jobs else None,
+        'download_process_cpu_seconds_per_job': round(download_process_cpu / jobs, 4) if jobs else None,
+        'ffmpeg_cpu_seconds_per_job': round(ffmpeg_cpu / jobs, 4) if jobs else None,
+        # The app process's own peak, and the largest peak of a download process (where yt-dlp's memory goes)
+        'peak_rss_mb': round(self_after.ru_maxrss / 1024, 1),
+        'download_process_peak_rss_mb': round(download_process_rss / 1024 / 1024, 1),
+        'stage_mean_seconds': stages,
+    }
+    print(json.dumps(result), file=results_out)
+
+
+if __name__ == '__main__':
+    main()
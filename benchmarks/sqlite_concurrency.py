@@ -0,0 +1,183 @@
+# Read latency of the Download hot queries while background workers keep writing status updates.
+#
+# Compares the old setup (rollback journal, no indexes) with the tuned one used by A.py
+# (WAL, synchronous=NORMAL, busy timeout, composite indexes) on a throwaway database.
+#
+#   python benchmarks/sqlite_concurrency.py --users 200 --rows-per-user 200 --seconds 10
+#
+# Prints one JSON object per mode so results can be diffed between releases.
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+SCHEMA = '''
+CREATE TABLE download (
+    id INTEGER NOT NULL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    title VARCHAR(200) NOT NULL,
+    url VARCHAR(500) NOT NULL,
+    download_type VARCHAR(10) NOT NULL,
+    status VARCHAR(20),
+    filename VARCHAR(200),
+    created_at DATETIME,
+    updated_at DATETIME
+)
+'''
+
+# Same indexes as Download.__table_args__ in A.py
+INDEXES = [
+    'CREATE INDEX ix_download_user_created ON download (user_id, created_at)',
+    'CREATE INDEX ix_download_user_updated ON download (user_id, updated_at)',
+    'CREATE INDEX ix_download_user_filename ON download (user_id, filename)',
+    'CREATE INDEX ix_download_filename ON download (filename)',
+]
+
+# The queries behind index(), check_status() and download_file(); True if it also takes a filename
+READ_QUERIES = [
+    ('SELECT * FROM download WHERE user_id = ? ORDER BY created_at DESC LIMIT 10', False),
+    ('SELECT max(updated_at), count(id) FROM download WHERE user_id = ?', False),
+    ('SELECT * FROM download WHERE user_id = ? AND filename = ? LIMIT 1', True),
+]
+
+
+def connect(path, tuned):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    if tuned:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+    else:
+        conn.execute('PRAGMA journal_mode=DELETE')
+    return conn
+
+
+def populate(path, tuned, users, rows_per_user):
+    conn = connect(path, tuned)
+    conn.execute(SCHEMA)
+    if tuned:
+        for statement in INDEXES:
+            conn.execute(statement)
+    start = datetime(2025, 1, 1)
+    rows = []
+    for i in range(users * rows_per_user):
+        user_id = i % users + 1
+        created = start + timedelta(seconds=i)
+        rows.append((user_id, f'title {i}', f'https://youtu.be/{i:011d}', 'audio', 'completed',
+                     f'{i}_file.mp3', created.isoformat(' '), created.isoformat(' ')))
+    conn.executemany('INSERT INTO download (user_id, title, url, download_type, status, filename, created_at, updated_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(mode, args):
+    tuned = mode == 'tuned'
+    directory = tempfile.mkdtemp(prefix='sqlite-bench-')
+    path = os.path.join(directory, 'bench.db')
+    populate(path, tuned, args.users, args.rows_per_user)
+
+    stop = threading.Event()
+    latencies = []
+    reads_lock = threading.Lock()
+    counters = {'writes': 0, 'write_errors': 0, 'read_errors': 0}
+    total_rows = args.users * args.rows_per_user
+
+    def reader(seed):
+        rng = random.Random(seed)
+        conn = connect(path, tuned)
+        local = []
+        while not stop.is_set():
+            user_id = rng.randint(1, args.users)
+            query, by_filename = rng.choice(READ_QUERIES)
+            params = (user_id, f'{rng.randint(0, total_rows)}_file.mp3') if by_filename else (user_id,)
+            started = time.perf_counter()
+            try:
+                conn.execute(query, params).fetchall()
+                local.append(time.perf_counter() - started)
+            except sqlite3.OperationalError:
+                with reads_lock:
+                    counters['read_errors'] += 1
+        conn.close()
+        with reads_lock:
+            latencies.extend(local)
+
+    # Mimics a download worker: a status change per job, committed on its own
+    def writer(seed):
+        rng = random.Random(seed)
+        conn = connect(path, tuned)
+        while not stop.is_set():
+            row_id = rng.randint(1, total_rows)
+            try:
+                conn.execute('UPDATE download SET status = ?, updated_at = ? WHERE id = ?',
+                             (rng.choice(['downloading', 'completed']), datetime.utcnow().isoformat(' '), row_id))
+                conn.commit()
+                with reads_lock:
+                    counters['writes'] += 1
+            except sqlite3.OperationalError:
+                with reads_lock:
+                    counters['write_errors'] += 1
+            time.sleep(args.write_interval)
+        conn.close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(1000 + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    os.remove(path)
+    for suffix in ('-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.rmdir(directory)
+
+    return {
+        'mode': mode,
+        'rows': total_rows,
+        'readers': args.readers,
+        'writers': args.writers,
+        'reads': len(latencies),
+        'reads_per_sec': round(len(latencies) / args.seconds, 1),
+        'read_p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'read_p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'read_p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'read_mean_ms': round(statistics.mean(latencies) * 1000, 3) if latencies else None,
+        'read_errors': counters['read_errors'],
+        'writes': counters['writes'],
+        'write_errors': counters['write_errors'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download table read latency under concurrent writes')
+    parser.add_argument('--mode', choices=['baseline', 'tuned', 'both'], default='both')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rows-per-user', type=int, default=100)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--write-interval', type=float, default=0.005, help='seconds between writes per writer')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    modes = ['baseline', 'tuned'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        print(json.dumps(run(mode, args)))
+
+
+if __name__ == '__main__':
+    main()